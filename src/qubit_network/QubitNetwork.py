@@ -8,24 +8,43 @@ import numbers
 import re
 import warnings
 
-import scipy.linalg
 import numpy as np
 import pandas as pd
-
-import theano
-import theano.tensor as T
-import theano.tensor.slinalg  # for expm()
-import theano.tensor.nlinalg  # for trace()
+import sympy
 
 import qutip
 
-from .utils import (chars2pair, complex2bigreal, bigreal2complex, chop,
-                    custom_dataframe_sort)
+from .utils import chars2pair, chop, custom_dataframe_sort
 from ._QubitNetwork import _find_suitable_name
-from .hamiltonian import QubitNetworkHamiltonian
+from .hamiltonian import QubitNetworkHamiltonian, _topology_products
 
 # from IPython.core.debugger import set_trace
 
+# `cufflinks` and `plotly.offline` are imported lazily, as they are slow
+# to import and only needed for plotting
+_CUFFLINKS = None
+_PLOTLY_OFFLINE = None
+
+
+def _ensure_cufflinks(online=False):
+    """Import `cufflinks` and `plotly.offline` once, and set the mode.
+
+    The online/offline mode of `cufflinks` is set on every call, as it is
+    cheap and could have been changed elsewhere in the meantime.
+    Returns the two modules.
+    """
+    global _CUFFLINKS, _PLOTLY_OFFLINE
+    if _CUFFLINKS is None:
+        import cufflinks
+        import plotly.offline
+        _CUFFLINKS = cufflinks
+        _PLOTLY_OFFLINE = plotly.offline
+    if online:
+        _CUFFLINKS.go_online()
+    else:
+        _CUFFLINKS.go_offline()
+    return _CUFFLINKS, _PLOTLY_OFFLINE
+
 
 class QubitNetwork(QubitNetworkHamiltonian):
     """Implement distinction between system and ancillae.
@@ -40,6 +59,7 @@ class QubitNetwork(QubitNetworkHamiltonian):
                  free_parameters_order=None):
         # parameters initialization
         self.ancillae_state = None  # initial values for ancillae (if any)
+        self.ancillae_vector = None  # same as above, as a numpy vector
         self.num_system_qubits = None  # number of input/output qubits
 
         # Initialize QubitNetworkHamiltonian parent. This computes
@@ -56,81 +76,104 @@ class QubitNetwork(QubitNetworkHamiltonian):
             self.num_system_qubits = num_system_qubits
         if self.num_system_qubits < self.num_qubits:
             self._initialize_ancillae(ancillae_state)
+        # Group the interactions sharing the same parameter, if the
+        # network was built from a topology
+        self._topology_groups = None
+        if self.net_topology is not None:
+            self._topology_groups = OrderedDict(
+                (symbol, []) for symbol in self.free_parameters)
+            for interaction, symbol in self.net_topology.items():
+                self._topology_groups[sympy.Symbol(str(symbol))].append(
+                    interaction)
 
     def _initialize_ancillae(self, ancillae_state):
         """Initialize ancillae states, as a qutip.Qobj object.
 
         The generated state has every ancillary qubit in the 0 state,
-        unless otherwise specified.
+        unless otherwise specified. The amplitudes of the state are also
+        stored as a flat numpy array in `self.ancillae_vector`.
         """
         num_ancillae = self.num_qubits - self.num_system_qubits
         if ancillae_state is not None:
             raise NotImplementedError('Custom specification of ancillae'
                                       ' state not implemented.')
-        state = qutip.tensor([qutip.basis(2, 0)
-                              for _ in range(num_ancillae)])
-        self.ancillae_state = state
+        # the tensor product of `num_ancillae` zero states is the first
+        # element of the computational basis
+        vector = np.zeros(2 ** num_ancillae, dtype=np.complex128)
+        vector[0] = 1.
+        self.ancillae_vector = vector
+        self.ancillae_state = qutip.Qobj(
+            vector[:, None], dims=[[2] * num_ancillae, [1] * num_ancillae])
 
     def J_index_to_interaction(self, index):
         """
-        Gives the tuple representing the interaction `self.J[index]`.
+        Gives the interaction of the parameter `self.free_parameters[index]`.
 
-        The set of (self-)interaction parameters of a qubit network is
-        stored in the `self.J` variable of the `QubitNetwork` instance.
-        This function is a utility to easily recover which interaction
-        corresponds to the given index.
+        The (self-)interaction parameters of a qubit network are listed
+        in `self.free_parameters`. This function is a utility to easily
+        recover which interaction corresponds to the given index.
 
         If `self.net_topology` has not been given, this is done by
         simply looking at `self.interactions`, which lists all (and
-        only) the active interactions in the network.
-        If a custom `self.net_topology` was given, then its value is
-        used to recover the (self-)interaction corresponding to the `J`
-        element. The output will therefore in this case be a list of
-        tuples, each one representing a single interaction.
+        only) the active interactions in the network, in the same order
+        as the parameters.
+        If a custom `self.net_topology` was given, then the interactions
+        sharing the parameter are returned. The output will therefore in
+        this case be a list of tuples, each one representing a single
+        interaction.
         """
         if self.net_topology is None:
             return self.interactions[index]
         else:
-            symbols = sorted(set(self.net_topology.values()))
-            interactions = []
-            for interaction, symb in self.net_topology.items():
-                if symb == symbols[index]:
-                    interactions.append(interaction)
-            return interactions
+            # a copy, so that the groups cannot be changed from outside
+            return list(self._topology_groups[self.free_parameters[index]])
 
     def remove_interaction(self, interaction_tuple):
-        """Removes the specified interaction from the network."""
+        """Removes the specified interaction from the network.
+
+        If the network was built from a list of interactions, the
+        interaction is removed together with its parameter. If it was
+        built from a topology, the interaction is removed from the group
+        of its parameter, and the parameter itself is removed only if no
+        other interaction shares it.
+
+        Returns the index in `self.free_parameters` of the removed
+        parameter, or None if no parameter was removed.
+        """
         if self.net_topology is None:
-            # in this case we just remove the specified interaction from
-            # the `self.interactions` list, and the corresponding entry
-            # in `self.J`
+            if self.interactions is None:
+                raise ValueError('Interactions can only be removed from '
+                                 'networks built from `interactions` or '
+                                 '`net_topology`.')
             idx = self.interactions.index(interaction_tuple)
-            Js = self.J.get_value()
-            del self.interactions[idx]
-            del Js[idx]
-            self.J.set_value(Js)
-        else:
-            # idx = list(self.net_topology.keys()).index(interaction_tuple)
-            symbol = self.net_topology[interaction_tuple]
-            all_interactions = [k for k, v in self.net_topology.items()
-                                if v == symbol]
-
-            # if there are interactions associated to the same symbol..
-            if len(all_interactions) > 1:
-                # then we just remove the corresponding entry in the
-                # `self.net_topology` variable (no need to change the
-                # value of `self.J`)
-                del self.net_topology[interaction_tuple]
-            # if there are interactions associated to the same parameter
-            elif len(all_interactions) == 1:
-                # then we also remove the corresponding entry of
-                # `self.J`, in addition to removing the entry in
-                # `self.net_topology`
-                symbols = self.net_topology_symbols
-                Js = self.J.get_value()
-                del Js[symbols.index(symbol)]
-                self.J.set_value(Js)
-                del self.net_topology_symbols[symbols.index(symbol)]
+            # build new lists rather than modifying in place the list of
+            # interactions, which may be the one given by the user
+            self.interactions = (self.interactions[:idx] +
+                                 self.interactions[idx + 1:])
+            del self.free_parameters[idx]
+            del self.matrices[idx]
+            return idx
+        # same as above, the given topology is not modified in place
+        net_topology = self.net_topology.copy()
+        symbol = sympy.Symbol(str(net_topology.pop(interaction_tuple)))
+        self.net_topology = net_topology
+        # the group is rebuilt rather than modified in place
+        group = [interaction
+                 for interaction in self._topology_groups[symbol]
+                 if interaction != interaction_tuple]
+        self._topology_groups[symbol] = group
+        idx = self.free_parameters.index(symbol)
+        # if no other interaction is associated to the same symbol, the
+        # symbol is removed altogether. Otherwise its matrix coefficient
+        # is recomputed from the remaining interactions of the group.
+        if not group:
+            del self._topology_groups[symbol]
+            del self.free_parameters[idx]
+            del self.matrices[idx]
+            return idx
+        self.matrices[idx] = sympy.Matrix(
+            _topology_products(self.num_qubits, group).sum(axis=0))
+        return None
 
     def get_grouped_interactions(self):
         """
@@ -139,36 +182,7 @@ class QubitNetwork(QubitNetworkHamiltonian):
         if self.net_topology is None:
             return self.interactions
         else:
-            outlist = []
-            for symbol in self.net_topology_symbols:
-                matching_interactions = []
-                for interaction, label in self.net_topology.items():
-                    if label == symbol:
-                        matching_interactions.append(interaction)
-                outlist.append(matching_interactions)
-            return outlist
-
-    def test_fidelity(self,
-                      states=None, target_states=None,
-                      target_gate=None,
-                      n_samples=10):
-        """Computes an average fidelity with the current values of J."""
-        if target_gate is None:
-            if self.target_gate is None:
-                raise ValueError('No target gate has been specified')
-            else:
-                target_gate = self.target_gate
-
-        if states is None or target_states is None:
-            states, target_states = self.generate_training_data(
-                target_gate, n_samples)
-
-        fidelity = theano.function(
-            inputs=[],
-            outputs=self.fidelity(states, target_states)
-        )
-        return fidelity()
-
+            return [list(group) for group in self._topology_groups.values()]
 
     def net_parameters_to_dataframe(self, stringify_index=False):
         """
@@ -177,39 +191,21 @@ class QubitNetwork(QubitNetworkHamiltonian):
         Parameters
         ----------
         stringify_index : bool
-            If True, instead of a MultiIndex the output DataFrame will have
-            a single index of strings, built applying `df.index.map(str)` to
-            the original index structure.
+            If True, the output DataFrame is indexed by the names of the
+            parameters, as strings, instead of by the sympy symbols.
 
         Returns
         -------
-        A `pandas.DataFrame` with the interaction parameters ordered by
-        qubits on which they act and type (interaction direction).
+        A `pandas.DataFrame` with the current value of each interaction
+        parameter, indexed by the corresponding sympy symbol.
         """
-        interactions, values = self.free_parameters, self.parameters.get_value()
+        interactions = self.free_parameters
+        values = self.parameters.get_value(borrow=True)
         # now put everything in dataframe
-        return pd.DataFrame({
+        pars_df = pd.DataFrame({
             'interaction': interactions,
             'value': values
         }).set_index('interaction')
-        # OLD STUFF, POSSIBLY OBSOLETE
-        parameters = self.get_interactions_with_Js()
-        qubits = []
-        directions = []
-        values = []
-        for key, value in parameters.items():
-            try:
-                qubits.append(tuple(key[0]))
-            except TypeError:
-                qubits.append((key[0], ))
-            directions.append(key[1])
-            values.append(value)
-
-        pars_df = pd.DataFrame({
-            'qubits': qubits,
-            'directions': directions,
-            'values': values
-        }).set_index(['qubits', 'directions']).sort_index()
         if stringify_index:
             pars_df.index = pars_df.index.map(str)
         return pars_df
@@ -219,11 +215,8 @@ class QubitNetwork(QubitNetworkHamiltonian):
                             overlay_hlines=None,
                             asFigure=False, **kwargs):
         """Plot the current values of the parameters of the network."""
-        import cufflinks
-        import plotly
-        df = self.net_parameters_to_dataframe()
         # stringify index (otherwise error is thrown by plotly)
-        df.index = df.index.map(str)
+        df = self.net_parameters_to_dataframe(stringify_index=True)
         # optionally sort the index, grouping together self-interactions
         # if sort_index:
         #     def sorter(elem):
@@ -234,10 +227,7 @@ class QubitNetwork(QubitNetworkHamiltonian):
         #     df = pd.DataFrame({'x': x, 'y': y}).set_index('x')
         #     df.index = df.index.map(str)
         # decide online/offline
-        if plotly_online:
-            cufflinks.go_online()
-        else:
-            cufflinks.go_offline()
+        _, plotly_offline = _ensure_cufflinks(online=plotly_online)
         # draw overlapping horizontal lines for reference if asked
         if overlay_hlines is None:
             overlay_hlines = np.arange(-np.pi, np.pi, np.pi / 2)
@@ -256,5 +246,5 @@ class QubitNetwork(QubitNetworkHamiltonian):
         if asFigure:
             return fig
         else:
-            return plotly.offline.iplot(fig)
+            return plotly_offline.iplot(fig)
             
\ No newline at end of file
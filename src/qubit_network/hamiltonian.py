@@ -6,11 +6,51 @@ import numbers
 import numpy as np
 import sympy
 
-import qutip
 import theano
 import theano.tensor as T
 
-from .utils import complex2bigreal
+from .utils import chars2pair, complex2bigreal
+
+# powers of -1j, indexed modulo 4
+_POWERS_OF_MINUS_J = np.array([1, -1j, -1, 1j], dtype=np.complex128)
+
+
+def _pauli_products(indices):
+    """
+    Return the tensor products of Pauli matrices for many interactions.
+
+    Each row of `indices` specifies an interaction as in `pauli_product`,
+    that is, as the list of indices of the Pauli matrices acting on each
+    qubit. The output is an array of shape `(len(indices), 2**n, 2**n)`,
+    with `n` the number of qubits.
+
+    Rather than chaining Kronecker products, every product is written
+    directly in the output array. A tensor product of Pauli matrices has
+    a single nonzero element in each row: X and Y flip the bit of their
+    qubit in the column index, while Y and Z contribute a sign depending
+    on the bit of their qubit in the row index (Y also a factor -1j).
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    if np.any((indices < 0) | (indices > 3)):
+        raise ValueError('Each index must be between 0 and 3.')
+    num_products, num_qubits = indices.shape
+    dim = 2 ** num_qubits
+    # the first qubit corresponds to the most significant bit
+    qubit_bits = 2 ** np.arange(num_qubits - 1, -1, -1)
+    flip_masks = ((indices == 1) | (indices == 2)).dot(qubit_bits)
+    sign_masks = ((indices == 2) | (indices == 3)).dot(qubit_bits)
+    num_ys = np.sum(indices == 2, axis=1)
+    rows = np.arange(dim)
+    # parity of the bits of each row index selected by `sign_masks`
+    masked_rows = rows[None, :] & sign_masks[:, None]
+    parities = np.zeros_like(masked_rows)
+    for qubit in range(num_qubits):
+        parities ^= (masked_rows >> qubit) & 1
+    values = _POWERS_OF_MINUS_J[num_ys % 4, None] * (1 - 2 * parities)
+    products = np.zeros((num_products, dim, dim), dtype=np.complex128)
+    products[np.arange(num_products)[:, None], rows[None, :],
+             rows[None, :] ^ flip_masks[:, None]] = values
+    return products
 
 
 def pauli_product(*args):
@@ -31,13 +71,27 @@ def pauli_product(*args):
                 raise ValueError('Each argument must be between 0 and 3.')
         except TypeError:
             raise ValueError('The inputs must be integers.')
-    n_qubits = len(args)
-    sigmas = [qutip.qeye(2), qutip.sigmax(), qutip.sigmay(), qutip.sigmaz()]
-    output_matrix = [None] * n_qubits
-    for idx, arg in enumerate(args):
-        output_matrix[idx] = sigmas[arg]
-    output_matrix = qutip.tensor(*output_matrix).data.toarray()
-    return sympy.Matrix(output_matrix)
+    return sympy.Matrix(_pauli_products([args])[0])
+
+
+def _topology_products(num_qubits, interactions):
+    """
+    Return the Pauli products for interactions given as topology keys.
+
+    Each element of `interactions` is either a tuple like `((1, 2), 'xy')`,
+    specifying the interacting qubits and the type of interaction, or a
+    tuple of Pauli indices like `(0, 1, 2)`, as in the keys of the
+    `net_topology` dictionaries.
+    """
+    # parse target tuples into an array of Pauli indices, one row per
+    # interaction, so that (2, 2) represents the YY interaction
+    indices = np.zeros((len(interactions), num_qubits), dtype=np.int64)
+    for row, tuple_ in zip(indices, interactions):
+        if isinstance(tuple_[1], str):
+            row[list(tuple_[0])] = chars2pair(tuple_[1])
+        else:
+            row[:] = tuple_
+    return _pauli_products(indices)
 
 
 def _self_interactions(num_qubits):
@@ -153,13 +207,13 @@ class QubitNetworkHamiltonian:
         """
         def make_symbols_and_matrices(interactions):
             self.free_parameters = []
-            self.matrices = []
             for interaction in interactions:
                 # create free parameter sympy symbol for interaction
                 new_symb = 'J' + ''.join(str(idx) for idx in interaction)
                 self.free_parameters.append(sympy.Symbol(new_symb))
-                # create matrix coefficient for symbol just created
-                self.matrices.append(pauli_product(*interaction))
+            # create matrix coefficients for all the symbols at once
+            self.matrices = [sympy.Matrix(matrix)
+                             for matrix in _pauli_products(interactions)]
         # store number of qubits in class
         if num_qubits is None:
             raise ValueError('The number of qubits must be given.')
@@ -214,35 +268,16 @@ class QubitNetworkHamiltonian:
         except TypeError:
             symbols = list(symbols)
         self.free_parameters = symbols
-        # parse target tuples so that (2, 2) represents the YY interaction
-        target_tuples = []
-        for tuple_ in topology.keys():
-            if isinstance(tuple_[1], str):
-                str_spec = list(tuple_[1])
-                new_tuple = [0] * num_qubits
-                for idx, char in zip(tuple_[0], str_spec):
-                    if char == 'x':
-                        new_tuple[idx] = 1
-                    elif char == 'y':
-                        new_tuple[idx] = 2
-                    elif char == 'z':
-                        new_tuple[idx] = 3
-                    else:
-                        raise ValueError('Only x, y or z are valid.')
-                target_tuples.append(tuple(new_tuple))
-            else:
-                target_tuples.append(tuple_)
         # Extract matrix coefficients for storing
         # The i-th element of `J` will correspond to the
         # interactions terms associated to the i-th symbol listed
         # in `symbols` (after sorting).
-        self.matrices = []
-        for idx, symb in enumerate(symbols):
-            factor = sympy.Matrix(np.zeros((2 ** num_qubits,) * 2))
-            for tuple_, label in zip(target_tuples, all_symbols):
-                if label == symb:
-                    factor += pauli_product(*tuple_)
-            self.matrices.append(factor)
+        products = _topology_products(num_qubits, list(topology.keys()))
+        labels = [symbols.index(symb) for symb in all_symbols]
+        factors = np.zeros((len(symbols),) + products.shape[1:],
+                           dtype=products.dtype)
+        np.add.at(factors, labels, products)
+        self.matrices = [sympy.Matrix(factor) for factor in factors]
 
     def get_matrix(self):
         """Return the Hamiltonian matrix as a sympy matrix object."""
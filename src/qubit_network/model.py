@@ -1,7 +1,6 @@
+from collections import OrderedDict
 import os
 import numbers
-import sympy
-import scipy
 import pandas as pd
 import numpy as np
 import qutip
@@ -12,8 +11,36 @@ import theano.tensor as T
 import matplotlib.pyplot as plt
 import seaborn as sns
 
-from .utils import complex2bigreal
-from .QubitNetwork import QubitNetwork
+from .utils import theano_bigreal_unitary_expm
+from .QubitNetwork import QubitNetwork, _ensure_cufflinks
+
+
+def _rows_to_bigreal(states):
+    """Convert each row of `states` to big real form.
+
+    The output is allocated once, with the precision used by theano,
+    and the real and imaginary parts are written directly into it.
+    """
+    num_states, dim = states.shape
+    bigreal_states = np.empty((num_states, 2 * dim),
+                              dtype=theano.config.floatX)
+    bigreal_states[:, :dim] = states.real
+    bigreal_states[:, dim:] = states.imag
+    return bigreal_states
+
+
+def _rows_from_bigreal(bigreal_states):
+    """Convert each row of `bigreal_states` back to complex form.
+
+    This is the inverse of `_rows_to_bigreal`. As in
+    `utils.bigreal2complex`, the complex output is filled in place.
+    """
+    bigreal_states = np.asarray(bigreal_states)
+    dim = bigreal_states.shape[1] // 2
+    states = np.empty((bigreal_states.shape[0], dim), dtype=np.complex128)
+    states.real = bigreal_states[:, :dim]
+    states.imag = bigreal_states[:, dim:]
+    return states
 
 
 def _gradient_updates_momentum(params, grad, learning_rate, momentum):
@@ -81,151 +108,60 @@ def _gradient_updates_adadelta(params, grads):
     return updates
 
 
-def _split_bigreal_ket(ket):
-    """Splits in half a real vector of length 2N
-
-    Given an input ket vector in big real form, returns a pair of real
-    vectors, the first containing the first N elements, and the second
-    containing the last N elements.
+def _gradient_updates_adam(params, grad, learning_rate,
+                           beta1=0.9, beta2=0.999, eps=1e-8):
     """
-    ket_real = ket[:ket.shape[0] // 2]
-    ket_imag = ket[ket.shape[0] // 2:]
-    return ket_real, ket_imag
-
-
-def _ket_to_dm(ket):
-    """Builds theano function to convert kets in dms in big real form.
+    Compute updates for the Adam method (Kingma and Ba 2014).
 
-    The input is expected to be a 1d real array, storing the state
-    vector as `(psi_real, psi_imag)`, where `psi` is the complex vector.
-    The outputs are real and imaginary part of the corresponding density
-    matrix.
+    As for the other methods, the step is taken along the gradient,
+    the cost being a fidelity to maximize.
     """
-    ket_real, ket_imag = _split_bigreal_ket(ket)
-    ket_real = ket_real[:, None]
-    ket_imag = ket_imag[:, None]
-
-    dm_real = ket_real * ket_real.T + ket_imag * ket_imag.T
-    dm_imag = ket_imag * ket_real.T - ket_real * ket_imag.T
-    return dm_real, dm_imag
-
-
-def _compute_fidelities_col_fn(col_idx, row_idx, matrix, num_ancillae):
-    """
-    `_compute_fidelities_col_fn` and `(...)row_fn` are the functions that
-    handle the computation of the partial traces. The latter is run on
-    each block of rows of the matrix to partial trace, with each block
-     containing `2 ** num_ancillae` rows.
-    For each block of rows, the former scans through the corresponding
-    blocks of columns, taking the trace of each resulting submatrix.
-    """
-    subm_dim = 2**num_ancillae
-    return T.nlinalg.trace(matrix[row_idx * subm_dim:(row_idx + 1) * subm_dim,
-                                  col_idx * subm_dim:(col_idx + 1) * subm_dim])
-
-
-def _compute_fidelities_row_fn(row_idx, matrix, num_ancillae):
-    """See `_compute_fidelities_col_fn`."""
-    results, _ = theano.scan(
-        fn=_compute_fidelities_col_fn,
-        sequences=T.arange(matrix.shape[1] // 2**num_ancillae),
-        non_sequences=[row_idx, matrix, num_ancillae])
-    return results
+    def shared_zeros_like(var):
+        return theano.shared(
+            var.get_value() * np.asarray(0, dtype=theano.config.floatX))
+    first_moment = shared_zeros_like(params)
+    second_moment = shared_zeros_like(params)
+    num_steps = theano.shared(np.asarray(0, dtype=theano.config.floatX))
+
+    new_num_steps = num_steps + 1
+    new_first_moment = beta1 * first_moment + (1 - beta1) * grad
+    new_second_moment = beta2 * second_moment + (1 - beta2) * grad**2
+    # bias-corrected step size
+    step_size = learning_rate * T.sqrt(
+        1 - beta2**new_num_steps) / (1 - beta1**new_num_steps)
+    params_step = step_size * new_first_moment / (
+        T.sqrt(new_second_moment) + eps)
+
+    updates = ((num_steps, new_num_steps),
+               (first_moment, new_first_moment),
+               (second_moment, new_second_moment),
+               (params, params + params_step))
+    return updates
 
 
+def _split_bigreal_ket(ket):
+    """Splits in half a real vector of length 2N
 
-def _fidelity_with_ptrace(i, matrix, target_states, num_ancillae):
+    Given an input ket vector in big real form, returns a pair of real
+    vectors, the first containing the first N elements, and the second
+    containing the last N elements. If `ket` is a matrix, each of its
+    rows is taken to be a ket, and the split happens along the rows.
     """
-    Compute fidelity between target and obtained states.
+    dim = ket.shape[-1] // 2
+    return ket[..., :dim], ket[..., dim:]
 
-    This function is intended to be called in `theano.scan` from
-    `QubitNetwork.fidelity`, and it operates with `theano` "symbolic"
-    tensor objects. It *does not* operate with numbers.
 
-    Parameters
-    ----------
-    i : int
-        Denotes the element to take from `matrix`. This is necessary
-        because of how `theano.scan` works (it is not possible to just
-        pass the corresponding matrix[i] element to the function).
-    matrix : theano 2d array
-        An array of training states. `matrix[i]` is the `i`-th training
-        state after evolution through `exp(-1j * H)`, *in big real ket
-        form*.
-        In other words, `matrix` is the set of states obtained after
-        the evolution through the net, to be compared with the
-        corresponding set of training target states.
-        `matrix[i]` has length `2 * (2 ** num_qubits)`, with
-    target_states : theano 2d array
-        The set of target states. `target_states[i]` is the state that
-        we would like `matrix[i]` to be equal to.
-    num_ancillae : int
-        The number of ancillae in the network.
-    """
-    # - `dm_real` and `dm_imag` will be square matrices of length
-    #   `2 ** num_qubits`.
-    dm_real, dm_imag = _ket_to_dm(matrix[i])
-    # `dm_real_traced` and `dm_imag_traced` are square matrices
-    # of length `2 ** num_system_qubits`.
-    dm_real_traced, _ = theano.scan(
-        fn=_compute_fidelities_row_fn,
-        sequences=T.arange(dm_real.shape[0] // 2**num_ancillae),
-        non_sequences=[dm_real, num_ancillae])
-    dm_imag_traced, _ = theano.scan(
-        fn=_compute_fidelities_row_fn,
-        sequences=T.arange(dm_imag.shape[0] // 2**num_ancillae),
-        non_sequences=[dm_imag, num_ancillae])
-
-    #  ---- Old method to compute trace of product of dms: ----
-    # target_dm_real, target_dm_imag = _ket_to_dm(target_states[i])
-
-    # prod_real = (T.dot(dm_real_traced, target_dm_real) -
-    #              T.dot(dm_imag_traced, target_dm_imag))
-    # tr_real = T.nlinalg.trace(prod_real)
-
-    # # we need only take the trace of the real part of the product,
-    # # as if \rho and \rho' are two Hermitian matrices, then
-    # # Tr(\rho_R \rho'_I) = Tr(\rho_I \rho'_R) = 0.
-    # return tr_real
-
-    # ---- New method: ----
-    target_real, target_imag = _split_bigreal_ket(target_states[i])
-
-    # `psi` and `psi_tilde` have length 2 * (2 ** numSystemQubits)
-    psi = target_states[i][:, None]
-    psi_tilde = T.concatenate((-target_imag, target_real))[:, None]
-    # `big_dm` is a square matrix with same length
-    big_dm = T.concatenate((
-        T.concatenate((dm_imag_traced, dm_real_traced), axis=1),
-        T.concatenate((-dm_real_traced, dm_imag_traced), axis=1)
-    ), axis=0)
-    out_fidelity = psi.T.dot(big_dm).dot(psi_tilde)
-    return out_fidelity
-
-
-def _fidelity_no_ptrace(i, states, target_states):
-    """
-    Compute symbolic fidelity between `states[i]` and `target_states[i]`.
+def _bigreal_times_j(ket):
+    """Big real form of `1j * ket`, given `ket` in big real form.
 
-    Both `states[i]` and `target_states[i]` are real vectors of same
-    length.
+    The real part of the inner product `<t|s>` is the plain dot product
+    of the big real forms of `t` and `s`, while its imaginary part is
+    the dot product of the big real forms of `1j * t` and `s`.
+    As for `_split_bigreal_ket`, the rows of a matrix are taken to be
+    different kets.
     """
-    state = states[i]
-    target_state = target_states[i]
-
-    # state_real = state[:state.shape[0] // 2]
-    # state_imag = state[state.shape[0] // 2:]
-    # target_state_real = target_state[:target_state.shape[0] // 2]
-    # target_state_imag = target_state[target_state.shape[0] // 2:]
-    state_real, state_imag = _split_bigreal_ket(state)
-    target_state_real, target_state_imag = _split_bigreal_ket(target_state)
-
-    fidelity_real = (T.dot(state_real, target_state_real) +
-                     T.dot(state_imag, target_state_imag))
-    fidelity_imag = (T.dot(state_real, target_state_imag) -
-                     T.dot(state_imag, target_state_real))
-    fidelity = fidelity_real ** 2 + fidelity_imag ** 2
-    return fidelity
+    ket_real, ket_imag = _split_bigreal_ket(ket)
+    return T.concatenate((-ket_imag, ket_real), axis=ket.ndim - 1)
 
 
 class TargetGateNotGivenError(Exception):
@@ -237,6 +173,10 @@ class QubitNetworkModel(QubitNetwork):
 
     Here we add the theano variables and functions to compute fidelity
     and so on.
+    The random initial parameters and training states are drawn from
+    `self.rng`, built from the `rng` argument with
+    `numpy.random.default_rng`, so that an integer seed makes them
+    reproducible.
     """
     def __init__(self, num_qubits=None, num_system_qubits=None,
                  interactions=None,
@@ -245,7 +185,8 @@ class QubitNetworkModel(QubitNetwork):
                  free_parameters_order=None,
                  ancillae_state=None,
                  initial_values=None,
-                 target_gate=None):
+                 target_gate=None,
+                 rng=None):
         # Initialize `QubitNetwork` parent
         super().__init__(num_qubits=num_qubits,
                          num_system_qubits=num_system_qubits,
@@ -255,17 +196,26 @@ class QubitNetworkModel(QubitNetwork):
                          sympy_expr=sympy_expr,
                          free_parameters_order=free_parameters_order)
         # attributes initialization
+        self.rng = np.random.default_rng(rng)  # for all random values
+        self.bigreal_matrices = None  # assigned in `build_theano_graph`
+        self._complex_matrices = None  # built by `_get_complex_matrices`
+        self._free_parameters_index = None  # parameter name -> position
+        self._evolution_matrix = None  # built by `compute_evolution_matrix`
+        self._has_optimizer = False  # set when an `Optimizer` is built
         self.initial_values = self._set_initial_values(initial_values)
         self.parameters, self.hamiltonian_model = self.build_theano_graph()
         # self.inputs and self.outputs are the holders for the training/testing
         # inputs and correpsonding output states. They are used to build
         # the theano expression for the `fidelity`.
-        self.inputs = T.dmatrix('inputs')
-        self.outputs = T.dmatrix('outputs')
+        self.inputs = T.matrix('inputs')
+        self.outputs = T.matrix('outputs')
         self.target_gate = target_gate
+        # compiled on the first call of `test_fidelity`
+        self._fidelity_function = None
 
     @staticmethod
-    def _fidelities_with_ptrace(output_states, target_states, num_ancillae):
+    def _fidelities_with_ptrace(output_states, target_states,
+                                num_system_qubits, num_ancillae):
         """Compute fidelities in the case of ancillary qubits.
 
         This function handles the case of the fidelity when the output
@@ -274,30 +224,57 @@ class QubitNetworkModel(QubitNetwork):
         the ancillary degrees of freedom of the output, and taking the
         fidelity of the resulting density matrix with the target
         (pure) state.
+
+        The fidelity between the reduced density matrix and a target
+        state `|t>` equals `sum_a |<t|psi_a>|^2`, where `|psi_a>` is the
+        (unnormalized) state of the system when the ancillae are projected
+        on the `a`-th element of the computational basis. These overlaps
+        are computed for all the states at once, without ever building
+        the density matrices. Being a sum of squared moduli, the result
+        is real by construction, so no imaginary part is ever computed.
         """
-        num_states = output_states.shape[0]
-        fidelities, _ = theano.scan(
-            fn=_fidelity_with_ptrace,
-            sequences=T.arange(num_states),
-            non_sequences=[output_states, target_states, num_ancillae]
-        )
-        return fidelities
+        dim_ancillae = 2 ** num_ancillae
+        dim_system = 2 ** num_system_qubits
+        # the index of a component of the output states factorizes as
+        # `system_index * dim_ancillae + ancilla_index`, so that the
+        # reshaped outputs hold the big real form of the system state
+        # along their second axis, for each basis state of the ancillae.
+        # Only the number of states is left symbolic in the new shape.
+        states = output_states.reshape((-1, 2 * dim_system, dim_ancillae))
+        # real and imaginary parts of the overlaps between each target
+        # state and the corresponding output state, for each basis state
+        # of the ancillae, contracted all at once as a tensor of shape
+        # `(num_states, 2, dim_ancillae)`
+        targets = T.stack((target_states, _bigreal_times_j(target_states)),
+                          axis=1)
+        overlaps = T.batched_dot(targets, states)
+        return T.sum(T.sqr(overlaps), axis=(1, 2))
 
     @staticmethod
     def _fidelities_no_ptrace(output_states, target_states):
         """Compute fidelities when there are no ancillary qubits.
+
+        The overlaps between each output state and the corresponding
+        target state are computed for all the states at once.
         """
-        num_states = output_states.shape[0]
-        fidelities, _ = theano.scan(
-            fn=_fidelity_no_ptrace,
-            sequences=T.arange(num_states),
-            non_sequences=[output_states, target_states]
-        )
-        return fidelities
+        overlaps_real = T.sum(target_states * output_states, axis=1)
+        overlaps_imag = T.sum(_bigreal_times_j(target_states) * output_states,
+                              axis=1)
+        return T.sqr(overlaps_real) + T.sqr(overlaps_imag)
 
     def compute_evolution_matrix(self):
-        """Compute matrix exponential of iH."""
-        return T.slinalg.expm(self.hamiltonian_model)
+        """Compute matrix exponential of iH.
+
+        The graph is built on the first call and the same node is
+        returned afterwards, so that all the graphs built on top of it
+        (like training cost and test fidelity) share it. As the
+        Hamiltonian is Hermitian, the exponential is computed from its
+        eigendecomposition (see `theano_bigreal_unitary_expm`).
+        """
+        if self._evolution_matrix is None:
+            self._evolution_matrix = theano_bigreal_unitary_expm(
+                self.hamiltonian_model)
+        return self._evolution_matrix
 
     def _target_outputs_from_inputs_open_map(self, input_states):
         raise NotImplementedError('Not implemented yet')
@@ -315,12 +292,32 @@ class QubitNetworkModel(QubitNetwork):
             target_states.append(evolved_ket)
         return target_states
 
+    def _random_input_states(self, num_states):
+        """Generate Haar random kets over the system qubits.
+
+        The kets are the rows of the output array. Normalizing complex
+        gaussian vectors gives Haar distributed states.
+        """
+        shape = (num_states, 2 ** self.num_system_qubits)
+        states = (self.rng.standard_normal(shape) +
+                  1j * self.rng.standard_normal(shape))
+        states /= np.linalg.norm(states, axis=1)[:, None]
+        return states
+
+    def _tensor_with_ancillae(self, states):
+        """Tensor each row of `states` with the initial ancillae state."""
+        if self.num_system_qubits == self.num_qubits:
+            return states
+        states = states[:, :, None] * self.ancillae_vector[None, None, :]
+        return states.reshape((states.shape[0], -1))
+
     def _target_outputs_from_inputs(self, input_states):
         # defer operation to other method for open maps
         if self.target_gate.issuper:
             return self._target_outputs_from_inputs_open_map(input_states)
-        # unitary evolution of input states. `target_gate` is qutip obj
-        return [self.target_gate * psi for psi in input_states]
+        # unitary evolution of input states, stored as rows of a matrix.
+        # `target_gate` is qutip obj
+        return input_states.dot(self.target_gate.full().T)
 
     def generate_training_states(self, num_states):
         """Create training states for the training.
@@ -349,47 +346,46 @@ class QubitNetworkModel(QubitNetwork):
             the corresponding `training_state` through the matrix
             `target_unitary`.
 
-        This generation method is highly non-optimal. However, it takes
-        about ~250ms to generate a (standard) training set of 100 states,
-        which amounts to ~5 minutes over 1000 epochs with a training dataset
-        size of 100, making this factor not particularly important.
+        All the states are generated at once as rows of numpy arrays,
+        without going through qutip objects.
         """
         assert self.target_gate is not None, 'target_gate not set'
 
         # 1) Generate random input states over system qubits
-        # `rand_ket_haar` seems to be slightly faster than `rand_ket`
-        length_inputs = 2 ** self.num_system_qubits
-        qutip_dims = [[2 for _ in range(self.num_system_qubits)],
-                      [1 for _ in range(self.num_system_qubits)]]
-        training_inputs = [
-            qutip.rand_ket_haar(length_inputs, dims=qutip_dims)
-            for _ in range(num_states)
-        ]
+        training_inputs = self._random_input_states(num_states)
         # 2) Compute corresponding output states
         target_outputs = self._target_outputs_from_inputs(training_inputs)
         # 3) Tensor product of training input states with ancillae
-        for idx, ket in enumerate(training_inputs):
-            if self.num_system_qubits < self.num_qubits:
-                ket = qutip.tensor(ket, self.ancillae_state)
-            training_inputs[idx] = complex2bigreal(ket)
-        training_inputs = np.asarray(training_inputs)
-        # 4) Convert target outputs in big real form.
-        # NOTE: the target states are kets if the target gate is unitary,
-        #       and density matrices for target open maps.
-        target_outputs = np.asarray(
-            [complex2bigreal(st) for st in target_outputs])
-        # return results as matrices
-        _, len_inputs, _ = training_inputs.shape
-        _, len_outputs, _ = target_outputs.shape
-        training_inputs = training_inputs.reshape((num_states, len_inputs))
-        target_outputs = target_outputs.reshape((num_states, len_outputs))
-        return training_inputs, target_outputs
+        training_inputs = self._tensor_with_ancillae(training_inputs)
+        # 4) Convert inputs and target outputs in big real form
+        return (_rows_to_bigreal(training_inputs),
+                _rows_to_bigreal(target_outputs))
+
+    @staticmethod
+    def _fidelities_numpy(output_states, target_states):
+        """Compute fidelities between complex states with numpy.
+
+        The states are the rows of `output_states` and `target_states`,
+        given as complex arrays. The output states can span a larger
+        space than the targets, in which case the partial trace over the
+        ancillary degrees of freedom is taken.
+        """
+        # the reduced density matrix of each output state is
+        # `sum_a |psi_a><psi_a|`, with `|psi_a>` the system component
+        # paired with the a-th ancillae basis state, so that the fidelity
+        # with the target is `sum_a |<target|psi_a>|^2`
+        outputs = output_states.reshape(
+            (output_states.shape[0], target_states.shape[1], -1))
+        overlaps = np.einsum('ni,nia->na', target_states.conj(), outputs)
+        return np.sum(np.abs(overlaps) ** 2, axis=1)
 
     def fidelity_test(self, n_samples=10, return_mean=True):
-        """Compute fidelity with current interaction values with qutip.
+        """Compute fidelity with current interaction values with numpy.
 
-        This can be used to compute the fidelity avoiding the
-        compilation of the theano graph done by `self.fidelity`.
+        The fidelities are computed on `n_samples` random input states,
+        for all of them at once. This can be used to compute the fidelity
+        avoiding the compilation of the theano graph done by
+        `self.fidelity`.
 
         Raises
         ------
@@ -399,33 +395,15 @@ class QubitNetworkModel(QubitNetwork):
         if self.target_gate is None:
             raise TargetGateNotGivenError('You must give a target gate'
                                           ' first.')
-        target_gate = self.target_gate
-        gate = qutip.Qobj(self.get_current_gate(),
-                          dims=[[2] * self.num_qubits] * 2)
+        gate = self.get_current_gate(return_qobj=False)
         # each element of `fidelities` will contain the fidelity obtained with
-        # a single randomly generated input state
-        fidelities = np.zeros(n_samples)
-        for idx in range(fidelities.shape[0]):
-            # generate random input state (over system qubits only)
-            psi_in = qutip.rand_ket_haar(2 ** self.num_system_qubits)
-            psi_in.dims = [
-                [2] * self.num_system_qubits, [1] * self.num_system_qubits]
-            # embed it into the bigger system+ancilla space (if necessary)
-            if self.num_system_qubits < self.num_qubits:
-                Psi_in = qutip.tensor(psi_in, self.ancillae_state)
-            else:
-                Psi_in = psi_in
-            # evolve input state
-            Psi_out = gate * Psi_in
-            # trace out ancilla (if there is an ancilla to trace)
-            if self.num_system_qubits < self.num_qubits:
-                dm_out = Psi_out.ptrace(range(self.num_system_qubits))
-            else:
-                dm_out = qutip.ket2dm(Psi_out)
-            # compute fidelity
-            fidelity = (psi_in.dag() * target_gate.dag() *
-                        dm_out * target_gate * psi_in)
-            fidelities[idx] = fidelity[0, 0].real
+        # a single randomly generated input state (over system qubits only)
+        inputs = self._random_input_states(n_samples)
+        targets = self._target_outputs_from_inputs(inputs)
+        # embed the inputs into the system+ancilla space (if necessary)
+        # and evolve them
+        outputs = self._tensor_with_ancillae(inputs).dot(gate.T)
+        fidelities = self._fidelities_numpy(outputs, targets)
         if return_mean:
             return fidelities.mean()
         else:
@@ -444,7 +422,8 @@ class QubitNetworkModel(QubitNetwork):
         num_ancillae = self.num_qubits - self.num_system_qubits
         if num_ancillae > 0:
             fidelities = self._fidelities_with_ptrace(
-                output_states, self.outputs, num_ancillae)
+                output_states, self.outputs,
+                self.num_system_qubits, num_ancillae)
         else:
             fidelities = self._fidelities_no_ptrace(output_states,
                                                     self.outputs)
@@ -453,6 +432,35 @@ class QubitNetworkModel(QubitNetwork):
         else:
             return fidelities
 
+    def test_fidelity(self, states=None, target_states=None, n_samples=10,
+                      backend='theano'):
+        """Compute the average fidelity with the current parameters.
+
+        If `states` and `target_states` are not given, `n_samples` new
+        ones are generated with `generate_training_states`.
+        With the 'theano' backend, the theano function computing the
+        fidelity is compiled on the first call, and reused for all the
+        following ones. The 'numpy' backend computes the same quantity
+        eagerly with numpy, which avoids the compilation altogether and
+        is usually faster for small networks and few evaluations.
+        """
+        if states is None or target_states is None:
+            states, target_states = self.generate_training_states(n_samples)
+        if backend == 'numpy':
+            gate = self.get_current_gate(return_qobj=False)
+            # the states are the rows of the inputs, in big real form
+            states = _rows_from_bigreal(states)
+            target_states = _rows_from_bigreal(target_states)
+            return np.mean(self._fidelities_numpy(states.dot(gate.T),
+                                                  target_states))
+        elif backend != 'theano':
+            raise ValueError('Unknown backend {}.'.format(backend))
+        if self._fidelity_function is None:
+            self._fidelity_function = theano.function(
+                inputs=[self.inputs, self.outputs],
+                outputs=self.fidelity())
+        return self._fidelity_function(states, target_states)
+
     def _set_initial_values(self, values=None):
         """Set initial values for the parameters in the Hamiltonian.
 
@@ -461,7 +469,8 @@ class QubitNetworkModel(QubitNetwork):
         stored in self.initial_values from __init__
         """
         if values is None:
-            initial_values = np.random.randn(len(self.free_parameters))
+            initial_values = self.rng.standard_normal(
+                len(self.free_parameters))
         elif isinstance(values, numbers.Number):
             initial_values = np.ones(len(self.free_parameters)) * values
         # A dictionary can be used to directly set the values of some of
@@ -475,44 +484,71 @@ class QubitNetworkModel(QubitNetwork):
         # to zero.
         elif isinstance(values, dict):
             init_values = np.zeros(len(self.free_parameters))
-            symbols_dict = dict(zip(
-                self.free_parameters, range(len(self.free_parameters))))
-            for symb, value in values.items():
+            # the parameters are looked up by name, so that symbols and
+            # strings need no conversion
+            if self._free_parameters_index is None:
+                self._free_parameters_index = {
+                    str(par): idx
+                    for idx, par in enumerate(self.free_parameters)}
+            indices = []
+            for symb in values:
                 # if `symb` is a single number, make a 1-element tuple
                 if isinstance(symb, numbers.Number):
                     symb = (symb,)
-                # convert strings to corresponding sympy symbols
-                if isinstance(symb, str):
-                    symb = sympy.Symbol(symb)
                 # `symb` can be a tuple when a key is of the form
                 # `(1, 3)` to indicate an X1Z2 interaction.
-                elif isinstance(symb, tuple):
+                if isinstance(symb, tuple):
                     symb = 'J' + ''.join(str(char) for char in symb)
                 try:
-                    init_values[symbols_dict[symb]] = value
+                    indices.append(self._free_parameters_index[str(symb)])
                 except KeyError:
                     raise ValueError('The symbol {} doesn\'t match'
                                      ' any of the names of parameters of '
                                      'the model.'.format(str(symb)))
+            # set all the given values at once
+            init_values[indices] = list(values.values())
             initial_values = init_values
         else:
             initial_values = values
 
         return initial_values
 
+    def _get_complex_matrices(self):
+        """
+        Return the elements of `self.matrices` stacked in a complex array.
+
+        The array, of shape `(len(self.matrices), dim, dim)`, is only
+        computed on the first call, as the matrix coefficients do not
+        change during the training.
+        """
+        if self._complex_matrices is None:
+            matrices = np.array([np.asarray(matrix)
+                                 for matrix in self.matrices])
+            self._complex_matrices = matrices.astype(np.complex128)
+        return self._complex_matrices
+
     def _get_bigreal_matrices(self, multiply_by_j=True):
         """
         Multiply each element of `self.matrices` with `-1j`, and return
         them converted to big real form. Or optionally do not multiply
         with the imaginary unit and just return the matrix coefficients
         converted in big real form.
+
+        The matrices are returned stacked in a single contiguous array
+        of shape `(len(self.matrices), 2 * dim, 2 * dim)`.
         """
+        matrices = self._get_complex_matrices()
         if multiply_by_j:
-            return [complex2bigreal(-1j * matrix).astype(np.float)
-                    for matrix in self.matrices]
-        else:
-            return [complex2bigreal(matrix).astype(np.float)
-                    for matrix in self.matrices]
+            matrices = -1j * matrices
+        num_matrices, dim = matrices.shape[:2]
+        # fill the four blocks of all the big real matrices at once
+        bigreal_matrices = np.empty((num_matrices, 2 * dim, 2 * dim),
+                                    dtype=theano.config.floatX)
+        bigreal_matrices[:, :dim, :dim] = matrices.real
+        bigreal_matrices[:, :dim, dim:] = -matrices.imag
+        bigreal_matrices[:, dim:, :dim] = matrices.imag
+        bigreal_matrices[:, dim:, dim:] = matrices.real
+        return bigreal_matrices
 
     def build_theano_graph(self):
         """Build theano object corresponding to the Hamiltonian model.
@@ -527,16 +563,23 @@ class QubitNetworkModel(QubitNetwork):
         model, ***multiplied by -1j***.
         """
         # define the theano variables
+        # the shared variable takes ownership of a copy of the initial
+        # values, so that `self.initial_values` is not changed by training
         parameters = theano.shared(
-            value=np.zeros(len(self.free_parameters), dtype=np.float),
+            value=np.array(self.initial_values, dtype=theano.config.floatX),
             name='J',
-            borrow=True  # still not sure what this does
+            borrow=True
+        )
+        # the matrix coefficients only depend on the structure of the
+        # network, not on the values of the parameters, so we compute
+        # them only once and keep them around as a shared variable
+        self.bigreal_matrices = theano.shared(
+            value=self._get_bigreal_matrices(),
+            name='bigreal matrices',
+            borrow=True
         )
-        parameters.set_value(self.initial_values)
         # multiply variables with matrix coefficients
-        bigreal_matrices = self._get_bigreal_matrices()
-        theano_graph = T.tensordot(parameters, bigreal_matrices, axes=1)
-        # from IPython.core.debugger import set_trace; set_trace()
+        theano_graph = T.tensordot(parameters, self.bigreal_matrices, axes=1)
         return [parameters, theano_graph]
 
     def get_current_hamiltonian(self):
@@ -544,21 +587,66 @@ class QubitNetworkModel(QubitNetwork):
 
         The returned Hamiltonian is a numpy.ndarray object.
         """
-        ints_values = self.parameters.get_value()
-        matrices = [np.asarray(matrix).astype(np.complex)
-                    for matrix in self.matrices]
-        final_matrix = np.zeros_like(matrices[0])
-        for matrix, parameter in zip(matrices, ints_values):
-            final_matrix += parameter * matrix
-        return final_matrix
+        return np.tensordot(self.parameters.get_value(borrow=True),
+                            self._get_complex_matrices(), axes=1)
+
+    def get_gates(self, parameters):
+        """Return the gates implemented by many sets of parameters.
+
+        Each row of `parameters` is a set of values for the interactions,
+        ordered as `self.free_parameters`. The output is an array of
+        shape `(len(parameters), dim, dim)`, whose i-th element is the
+        gate implemented by the i-th set of values. The Hamiltonians are
+        all built with a single contraction, and exponentiated with a
+        single batched eigendecomposition, as they are Hermitian.
+        """
+        hamiltonians = np.tensordot(np.asarray(parameters),
+                                    self._get_complex_matrices(), axes=1)
+        eigenvalues, eigenvectors = np.linalg.eigh(hamiltonians)
+        return np.matmul(eigenvectors * np.exp(-1j * eigenvalues)[:, None],
+                         eigenvectors.conj().transpose(0, 2, 1))
 
     def get_current_gate(self, return_qobj=True):
-        """Return the gate implemented by current interaction values."""
-        gate = scipy.linalg.expm(-1j * self.get_current_hamiltonian())
+        """Return the gate implemented by current interaction values.
+
+        As the Hamiltonian is Hermitian, the gate `exp(-1j * H)` is
+        computed from the eigendecomposition of `H`.
+        """
+        gate = self.get_gates(
+            self.parameters.get_value(borrow=True)[None, :])[0]
         if return_qobj:
             return qutip.Qobj(gate, dims=[[2] * self.num_qubits] * 2)
         return gate
 
+    def remove_interaction(self, interaction_tuple):
+        """Removes the specified interaction from the model.
+
+        The shared variables holding the parameters and the matrix
+        coefficients are updated in place, so that the graphs built on
+        top of them stay valid, while the cached values derived from the
+        matrices are discarded. The remaining parameters keep their
+        current values.
+        The state of an `Optimizer` (its compiled functions and the
+        variables of its update rules) depends on the number of
+        parameters, so interactions can only be removed before any
+        `Optimizer` is built on the model, otherwise a RuntimeError is
+        raised.
+        """
+        if self._has_optimizer:
+            raise RuntimeError('Interactions cannot be removed after an '
+                               'Optimizer has been built on the network.')
+        idx = super().remove_interaction(interaction_tuple)
+        parameters = self.parameters.get_value()
+        if idx is not None:
+            parameters = np.delete(parameters, idx)
+            self.initial_values = np.delete(self.initial_values, idx)
+        self._complex_matrices = None
+        self._free_parameters_index = None
+        self._evolution_matrix = None
+        self._fidelity_function = None
+        self.parameters.set_value(parameters)
+        self.bigreal_matrices.set_value(self._get_bigreal_matrices())
+
 
 class Optimizer:
     """
@@ -572,10 +660,18 @@ class Optimizer:
                  batch_size=None,
                  n_epochs=None,
                  target_gate=None,
-                 sgd_method='momentum'):
+                 sgd_method='momentum',
+                 rng=None):
         # the net parameter can be a QubitNetwork object or a str
         self.net = Optimizer._load_net(net)
         self.net.target_gate = target_gate
+        # the network cannot change its parameters from now on, see
+        # `QubitNetworkModel.remove_interaction`
+        self.net._has_optimizer = True
+        # if given, `rng` (a seed or a numpy Generator) replaces the random
+        # generator of the network, used to draw the training states
+        if rng is not None:
+            self.net.rng = np.random.default_rng(rng)
         self.hyperpars = dict(
             train_dataset_size=training_dataset_size,
             test_dataset_size=test_dataset_size,
@@ -592,7 +688,6 @@ class Optimizer:
         inputs_length = 2 * 2**self.net.num_qubits
         outputs_length = 2 * 2**self.net.num_system_qubits
         self.vars = dict(
-            index=T.lscalar('minibatch index'),
             learning_rate=_sharedfloat(learning_rate, 'learning rate'),
             train_inputs=_sharedfloat(
                 np.zeros((training_dataset_size, inputs_length)),
@@ -613,23 +708,33 @@ class Optimizer:
         self.grad = T.grad(cost=self.cost, wrt=self.vars['parameters'])
         self.train_model = None  # to be assigned in `compile_model`
         self.test_model = None  # assigned in `compile_model`
+        # batch and training dataset sizes `train_model` was compiled for
+        self._compiled_sizes = None
         # define updates, to be performed at every call of `train_XXX`
         self.updates = self._make_updates(sgd_method)
         # initialize log to be filled with the history later
-        self.log = {'fidelities': None, 'parameters': None}
+        self.log = {'fidelities': None, 'parameters': None,
+                    'parameters_every': 1}
         # create figure object
         self._fig = None
         self._ax = None
+        self._line = None
 
     @classmethod
     def load(cls, file):
         """Load from saved file."""
         import pickle
         _, ext = os.path.splitext(file)
-        if ext != '.pickle':
-            raise NotImplementedError('Only pickle files for now!')
-        with open(file, 'rb') as f:
-            data = pickle.load(f)
+        if ext == '.pickle':
+            with open(file, 'rb') as f:
+                data = pickle.load(f)
+        elif ext == '.npz':
+            with np.load(file) as npz:
+                data = pickle.loads(npz['metadata'].tobytes())
+                data['optimization_data']['log'] = {
+                    key: npz[key] for key in npz.files if key != 'metadata'}
+        else:
+            raise NotImplementedError('Only pickle and npz files for now!')
         net_data = data['net_data']
         opt_data = data['optimization_data']
         # create QubitNetwork instance
@@ -686,7 +791,11 @@ class Optimizer:
         saved_log = dict()
         saved_log['fidelities'] = fids[:end_useful_log]
         if self.log['parameters'] is not None:
-            saved_log['parameters'] = self.log['parameters'][:end_useful_log]
+            # parameters are only stored every `parameters_every` epochs
+            every = self.log.get('parameters_every', 1)
+            saved_log['parameters'] = self.log['parameters'][
+                :(end_useful_log + every - 1) // every]
+            saved_log['parameters_every'] = every
         return saved_log
 
     def save_results(self, file):
@@ -704,7 +813,7 @@ class Optimizer:
             target_gate=self.net.target_gate,
             hyperparameters=self.hyperpars,
             initial_interactions=self.net.initial_values,
-            final_interactions=self._get_meaningful_history()['parameters'][-1]
+            final_interactions=self.vars['parameters'].get_value()
         )
         # cut redundant log history
         optimization_data['log'] = self._get_meaningful_history()
@@ -715,10 +824,20 @@ class Optimizer:
         if ext == '.pickle':
             import pickle
             with open(file, 'wb') as fp:
-                pickle.dump(data_to_save, fp)
+                pickle.dump(data_to_save, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            print('Successfully saved to {}'.format(file))
+        elif ext == '.npz':
+            import pickle
+            # the log history is stored as compressed arrays, while
+            # everything else is pickled and stored alongside it
+            log = optimization_data.pop('log')
+            metadata = np.frombuffer(
+                pickle.dumps(data_to_save, protocol=pickle.HIGHEST_PROTOCOL),
+                dtype=np.uint8)
+            np.savez_compressed(file, metadata=metadata, **log)
             print('Successfully saved to {}'.format(file))
         else:
-            raise ValueError('Only saving to pickle is supported.')
+            raise ValueError('Only saving to pickle or npz is supported.')
 
 
     def _make_updates(self, sgd_method):
@@ -735,88 +854,115 @@ class Optimizer:
         elif sgd_method == 'adadelta':
             updates = _gradient_updates_adadelta(
                 self.vars['parameters'], self.grad)
+        elif sgd_method == 'adam':
+            updates = _gradient_updates_adam(
+                self.vars['parameters'], self.grad,
+                self.vars['learning_rate'])
         else:
-            new_pars = self.vars['parameters']
-            new_pars += self.vars['learning_rate'] * self.grad
-            updates = [(self.vars['parameters'], new_pars)]
+            # plain gradient ascent
+            params = self.vars['parameters']
+            updates = [(params,
+                        params + self.vars['learning_rate'] * self.grad)]
         return updates
 
     def _update_fig(self, len_shown_history):
-        # retrieve or create figure object
+        # retrieve or create figure object. The line showing the
+        # fidelities is created only once, and then only its data are
+        # updated at every call.
         if self._fig is None:
             self._fig, self._ax = plt.subplots(1, 1, figsize=(10, 5))
+            self._line, = self._ax.plot([], [], '-b', linewidth=1)
         fig, ax = self._fig, self._ax
-        ax.clear()
         # plot new fidelities
         n_epoch = self.log['n_epoch']
         fids = self.log['fidelities']
-        if len_shown_history is None:
-            ax.plot(fids[:n_epoch], '-b', linewidth=1)
+        if len_shown_history is None or n_epoch + 1 < len_shown_history:
+            x_coords = np.arange(n_epoch + 1)
         else:
-            if n_epoch + 1 == len_shown_history:
-                x_coords = np.arange(
-                    n_epoch - len_shown_history + 1, n_epoch + 1)
-            else:
-                x_coords = np.arange(n_epoch + 1)
-            ax.plot(x_coords, fids[x_coords], '-b', linewidth=1)
-        plt.suptitle('learning rate: {}\nfidelity: {}'.format(
-            self.vars['learning_rate'].get_value(), fids[n_epoch]))
-        fig.canvas.draw()
+            x_coords = np.arange(
+                n_epoch - len_shown_history + 1, n_epoch + 1)
+        self._line.set_data(x_coords, fids[x_coords])
+        ax.relim()
+        ax.autoscale_view()
+        fig.suptitle('learning rate: {}\nfidelity: {}'.format(
+            self.vars['learning_rate'].get_value(borrow=True), fids[n_epoch]))
+        fig.canvas.draw_idle()
+        fig.canvas.flush_events()
 
     def refill_test_data(self):
         """Generate new test data and put them in shared variable.
+
+        The generated arrays are not used anywhere else, so they are
+        handed over to the shared variables without being copied.
         """
         inputs, outputs = self.net.generate_training_states(
             self.hyperpars['test_dataset_size'])
-        self.vars['test_inputs'].set_value(inputs)
-        self.vars['test_outputs'].set_value(outputs)
+        self.vars['test_inputs'].set_value(inputs, borrow=True)
+        self.vars['test_outputs'].set_value(outputs, borrow=True)
 
     def refill_training_data(self):
         """Generate new training data and put them in shared variable.
         """
         inputs, outputs = self.net.generate_training_states(
             self.hyperpars['train_dataset_size'])
-        self.vars['train_inputs'].set_value(inputs)
-        self.vars['train_outputs'].set_value(outputs)
+        self.vars['train_inputs'].set_value(inputs, borrow=True)
+        self.vars['train_outputs'].set_value(outputs, borrow=True)
 
     def train_epoch(self):
         """Generate training states and train for an epoch."""
         self.refill_training_data()
-        n_train_batches = (self.hyperpars['train_dataset_size'] //
-                           self.hyperpars['batch_size'])
-        for minibatch_index in range(n_train_batches):
-            self.train_model(minibatch_index)
+        self.train_model()
 
     def test_epoch(self, save_parameters=True):
         """Compute fidelity, and store fidelity and parameters."""
         fidelity = self.test_model()
         n_epoch = self.log['n_epoch']
-        if save_parameters:
-            self.log['parameters'][n_epoch] = (
-                self.vars['parameters'].get_value())
+        every = self.log['parameters_every']
+        if save_parameters and n_epoch % every == 0:
+            # the values are copied into the log, no need for another copy
+            self.log['parameters'][n_epoch // every] = (
+                self.vars['parameters'].get_value(borrow=True))
         self.log['fidelities'][n_epoch] = fidelity
 
     def _compile_model(self):
         """Compile train and test models.
 
-        Compile the training function `train_model`, that while computing
-        the cost at every iteration (batch), also updates the weights of
-        the network based on the rules defined in `updates`.
+        Compile the training function `train_model`, that loops over all
+        the minibatches of the training dataset and, while computing the
+        cost at every iteration (batch), also updates the weights of the
+        network based on the rules defined in `updates`. The loop is a
+        `theano.scan`, so that a whole epoch takes a single call.
         """
         batch_size = self.hyperpars['batch_size']
-        batch_start = self.vars['index'] * batch_size
-        batch_end = (self.vars['index'] + 1) * batch_size
-        train_inputs_batch = self.vars['train_inputs'][batch_start: batch_end]
-        train_outputs_batch = self.vars['train_outputs'][batch_start: batch_end]
+        n_train_batches = self.hyperpars['train_dataset_size'] // batch_size
+        # theano's scan cannot loop over zero minibatches
+        if n_train_batches == 0:
+            raise ValueError('batch_size larger than training_dataset_size.')
+        self._compiled_sizes = (batch_size,
+                                self.hyperpars['train_dataset_size'])
+        updated_vars = [var for var, _ in self.updates]
+
+        def train_minibatch(index):
+            batch_start = index * batch_size
+            batch_end = (index + 1) * batch_size
+            givens = {
+                self.net.inputs:
+                    self.vars['train_inputs'][batch_start: batch_end],
+                self.net.outputs:
+                    self.vars['train_outputs'][batch_start: batch_end]
+            }
+            # cost and updates are cloned together so that they keep
+            # sharing the common parts of their graphs
+            cost, *new_values = theano.clone(
+                [self.cost] + [update for _, update in self.updates],
+                replace=givens)
+            return cost, OrderedDict(zip(updated_vars, new_values))
+
         print('Compiling model ...', end='')
+        costs, updates = theano.scan(fn=train_minibatch,
+                                     sequences=T.arange(n_train_batches))
         self.train_model = theano.function(
-            inputs=[self.vars['index']],
-            outputs=self.cost,
-            updates=self.updates,
-            givens={
-                self.net.inputs: train_inputs_batch,
-                self.net.outputs: train_outputs_batch
-            })
+            inputs=[], outputs=costs, updates=updates)
         # `test_model` is used to test the fidelity given by the currently
         # trained parameters. It's called at regular intervals during
         # the computation, and is the value shown in the dynamically
@@ -829,25 +975,44 @@ class Optimizer:
                     self.net.outputs: self.vars['test_outputs']})
         print(' done.')
 
-    def _run(self, save_parameters=True, len_shown_history=200):
+    def _run(self, save_parameters=True, len_shown_history=200,
+             plot_every=10, parameters_every=1):
         # generate testing states
         self.refill_test_data()
-        self._compile_model()
+        # the compiled functions only depend on the graph and on the
+        # batch and training dataset sizes, so they are reused by
+        # subsequent runs as long as the latter are not changed
+        sizes = (self.hyperpars['batch_size'],
+                 self.hyperpars['train_dataset_size'])
+        if self.train_model is None or self._compiled_sizes != sizes:
+            self._compile_model()
 
         n_epochs = self.hyperpars['n_epochs']
         # initialize log
         self.log['fidelities'] = np.zeros(n_epochs)
+        self.log['parameters_every'] = parameters_every
         if save_parameters:
-            self.log['parameters'] = np.zeros((
-                n_epochs, len(self.vars['parameters'].get_value())))
+            num_parameters = len(
+                self.vars['parameters'].get_value(borrow=True))
+            num_saved_epochs = (n_epochs - 1) // parameters_every + 1
+            self.log['parameters'] = np.zeros(
+                (num_saved_epochs, num_parameters),
+                dtype=theano.config.floatX)
         # run epochs
         for n_epoch in range(n_epochs):
             self.log['n_epoch'] = n_epoch
             self.train_epoch()
             self.test_epoch(save_parameters=save_parameters)
-            self._update_fig(len_shown_history)
+            converged = self.log['fidelities'][n_epoch] == 1
+            # redrawing the figure can take longer than a training epoch
+            # for small networks, so it is only done every few epochs,
+            # and for the last epoch when the run ends
+            if plot_every is not None and (
+                    n_epoch % plot_every == 0 or
+                    n_epoch == n_epochs - 1 or converged):
+                self._update_fig(len_shown_history)
             # stop if fidelity 1 is obtained
-            if self.log['fidelities'][n_epoch] == 1:
+            if converged:
                 print('Fidelity 1 obtained, stopping.')
                 break
             # update learning rate
@@ -856,7 +1021,7 @@ class Optimizer:
                     1 + self.hyperpars['decay_rate'] * n_epoch))
 
     def run(self, save_parameters=True, len_shown_history=200,
-            save_after=None):
+            save_after=None, plot_every=10, parameters_every=1):
         """
         Start the optimization.
 
@@ -869,22 +1034,35 @@ class Optimizer:
             only shows the last `len_shown_history` epochs.
         save_after : str, optional
             If not None, it is used to save the results to file.
+        plot_every : int, optional
+            The figure showing the fidelities is only updated every
+            `plot_every` epochs (and at the last epoch). If None, no
+            figure is drawn at all.
+        parameters_every : int, optional
+            If `save_parameters` is True, the parameters are only stored
+            every `parameters_every` epochs.
         """
-        args = locals()
         # catch abort to stop training at will
         try:
-            self._run(args)
+            self._run(save_parameters=save_parameters,
+                      len_shown_history=len_shown_history,
+                      plot_every=plot_every,
+                      parameters_every=parameters_every)
         except KeyboardInterrupt:
             pass
 
         if save_after is not None:
-            self._save_results()
+            self.save_results(save_after)
 
     def plot_parameters_history(self, return_fig=False, return_df=False,
                                 online=False):
-        import cufflinks
+        # `df.iplot` is only available once cufflinks is imported
+        _ensure_cufflinks(online=online)
         names = [par.name for par in self.net.free_parameters]
-        df = pd.DataFrame(self._get_meaningful_history()['parameters'])
+        history = self._get_meaningful_history()
+        df = pd.DataFrame(history['parameters'])
+        # index the parameters with the epoch at which they were stored
+        df.index *= history['parameters_every']
         new_col_names = dict(zip(range(df.shape[1]), names))
         df.rename(columns=new_col_names, inplace=True)
         if return_df:
@@ -29,6 +29,57 @@ class TestQubitNetworkHamiltonian(unittest.TestCase):
                                         [1.0*b, 1.0*a, 0, 0]])))
         self.assertEqual(net.num_qubits, 2)
 
+    def test_topology_groups(self):
+        topology = {((0, 1), 'xx'): 'a',
+                    ((1, 2), 'xx'): 'a',
+                    ((0, 2), 'zz'): 'b'}
+        net = QubitNetwork(num_qubits=3, net_topology=topology)
+        # the order of the parameters is not guaranteed
+        a_index = net.free_parameters.index(sympy.Symbol('a'))
+        b_index = net.free_parameters.index(sympy.Symbol('b'))
+        groups = net.get_grouped_interactions()
+        self.assertListEqual(groups[a_index],
+                             [((0, 1), 'xx'), ((1, 2), 'xx')])
+        self.assertListEqual(groups[b_index], [((0, 2), 'zz')])
+        self.assertListEqual(net.J_index_to_interaction(b_index),
+                             [((0, 2), 'zz')])
+
+    def test_remove_interaction_from_topology(self):
+        topology = {((0, 1), 'xx'): 'a',
+                    ((1, 2), 'xx'): 'a',
+                    ((0, 2), 'zz'): 'b'}
+        net = QubitNetwork(num_qubits=3, net_topology=topology)
+        a_index = net.free_parameters.index(sympy.Symbol('a'))
+        a_group = net.J_index_to_interaction(a_index)
+        # removing an interaction sharing its parameter keeps the parameter
+        self.assertIsNone(net.remove_interaction(((0, 1), 'xx')))
+        # the lists previously returned are not changed
+        self.assertListEqual(a_group, [((0, 1), 'xx'), ((1, 2), 'xx')])
+        a_group.append(((0, 2), 'xx'))
+        self.assertEqual(len(topology), 3)
+        self.assertListEqual(net.J_index_to_interaction(a_index),
+                             [((1, 2), 'xx')])
+        self.assertEqual(net.matrices[a_index],
+                         pauli_product(0, 1, 1))
+        # removing the last interaction of a group removes the parameter
+        b_index = net.free_parameters.index(sympy.Symbol('b'))
+        self.assertEqual(net.remove_interaction(((0, 2), 'zz')), b_index)
+        self.assertListEqual(net.free_parameters, [sympy.Symbol('a')])
+        self.assertEqual(len(net.matrices), 1)
+        self.assertListEqual(net.get_grouped_interactions(),
+                             [[((1, 2), 'xx')]])
+        self.assertListEqual(net.J_index_to_interaction(0),
+                             [((1, 2), 'xx')])
+
+    def test_ancillae_vector(self):
+        net = QubitNetwork(num_qubits=3, num_system_qubits=1,
+                           interactions='all')
+        assert_array_equal(net.ancillae_vector, [1, 0, 0, 0])
+        self.assertEqual(net.ancillae_state,
+                         qutip.tensor(qutip.basis(2, 0), qutip.basis(2, 0)))
+        assert_array_equal(net.ancillae_vector,
+                           net.ancillae_state.full().ravel())
+
 
 if __name__ == '__main__':
     # change path to properly import qubit_network package when called
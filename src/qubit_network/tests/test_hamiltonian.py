@@ -1,4 +1,5 @@
 # pylint: skip-file
+import itertools
 import unittest
 import sys
 import os
@@ -24,6 +25,15 @@ class TestPauliProduct(unittest.TestCase):
             [0, 0, 0, 1.0, 0, 0, 1.0, 0, 0, 1.0, 0, 0, 1.0, 0, 0, 0]
         )
 
+    def test_pauli_products_batch(self):
+        sigmas = [qutip.qeye(2), qutip.sigmax(), qutip.sigmay(), qutip.sigmaz()]
+        indices = list(itertools.product(range(4), repeat=3))
+        products = _pauli_products(indices)
+        self.assertEqual(products.shape, (64, 8, 8))
+        for product, idxs in zip(products, indices):
+            expected = qutip.tensor(*[sigmas[idx] for idx in idxs])
+            assert_array_equal(product, expected.data.toarray())
+
 
 class TestQubitNetworkHamiltonian(unittest.TestCase):
     def test_parse_from_sympy_expr(self):
@@ -131,6 +141,6 @@ if __name__ == '__main__':
     PARENTDIR = os.path.dirname(os.path.dirname(CURRENTDIR))
     sys.path.insert(1, PARENTDIR)
     from qubit_network.hamiltonian import (QubitNetworkHamiltonian,
-                                           pauli_product)
+                                           pauli_product, _pauli_products)
     from qubit_network.utils import complex2bigreal
     unittest.main()
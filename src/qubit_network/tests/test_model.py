@@ -3,10 +3,12 @@ import unittest
 import sys
 import os
 import inspect
+import tempfile
 
 import numpy as np
 from numpy.testing import assert_array_equal, assert_almost_equal
 import scipy
+import scipy.linalg
 import sympy
 
 import qutip
@@ -31,7 +33,7 @@ class TestFidelityGraph(unittest.TestCase):
         newJ[net.free_parameters.index(a)] = 1
         net.parameters.set_value(newJ)
         new_evolution = complex2bigreal(
-            scipy.linalg.expm(-1j * np.asarray(x1).astype(np.complex)))
+            scipy.linalg.expm(-1j * np.asarray(x1).astype(np.complex128)))
         assert_almost_equal(compute_evolution(), new_evolution)
         # try with a=1.3, b=-3.
         newJ = [0, 0]
@@ -39,7 +41,7 @@ class TestFidelityGraph(unittest.TestCase):
         newJ[net.free_parameters.index(b)] = -3
         net.parameters.set_value(newJ)
         new_evolution = complex2bigreal(scipy.linalg.expm(
-            -1j * np.asarray(1.3 * x1 - 3 * xx).astype(np.complex)))
+            -1j * np.asarray(1.3 * x1 - 3 * xx).astype(np.complex128)))
         assert_almost_equal(compute_evolution(), new_evolution)
 
     def test_evolution_matrix_y1_zz(self):
@@ -73,7 +75,6 @@ class TestFidelityGraph(unittest.TestCase):
             some_target_gate.data.toarray() 
         )
 
-
     def test_generation_training_states(self):
         J20, J33 = sympy.symbols('J20 J33')
         y1 = pauli_product(2, 0)
@@ -108,9 +109,9 @@ class TestFidelityGraph(unittest.TestCase):
         state1 = state1.astype(theano.config.floatX)
         state2 = state2.astype(theano.config.floatX)
         fidelity_theano = theano.function(
-            [], _fidelity_no_ptrace(0, state1, state2))()
+            [], QubitNetworkModel._fidelities_no_ptrace(state1, state2))()
         # check they are compatible
-        assert_almost_equal(fidelity_np, fidelity_theano)
+        assert_almost_equal(fidelity_theano, [fidelity_np])
 
     def test_fidelities_no_ptrace_identity(self):
         net = QubitNetworkModel(
@@ -132,7 +133,21 @@ class TestFidelityGraph(unittest.TestCase):
         fidelity = theano.function([], net.fidelity(), givens={
             net.inputs: inputs, net.outputs: outputs})()
         assert_almost_equal(fidelity, np.array(1))
-    
+
+    def test_test_fidelity(self):
+        net = QubitNetworkModel(
+            num_qubits=2, interactions='all', initial_values=0)
+        net.target_gate = qutip.qeye([2, 2])
+        assert_almost_equal(net.test_fidelity(n_samples=4), np.array(1))
+        # the compiled function is reused, and sees the new parameters
+        compiled_function = net._fidelity_function
+        net.parameters.set_value(np.random.randn(len(net.free_parameters)))
+        inputs, outputs = net.generate_training_states(4)
+        fidelities = theano.function([], net.fidelity(), givens={
+            net.inputs: inputs, net.outputs: outputs})()
+        assert_almost_equal(net.test_fidelity(inputs, outputs), fidelities)
+        self.assertIs(net._fidelity_function, compiled_function)
+
     def test_fidelity_no_ptrace_y1_zz(self):
         J20, J33 = sympy.symbols('J20 J33')
         y1 = pauli_product(2, 0)
@@ -171,6 +186,154 @@ class TestFidelityGraph(unittest.TestCase):
         # check results are compatible
         assert_almost_equal(fidelities, fidelities_check)
 
+    def test_fidelity_with_ptrace(self):
+        # two system qubits plus one ancilla, random parameters
+        net = QubitNetworkModel(num_qubits=3, num_system_qubits=2,
+                                interactions='all')
+        net.target_gate = qutip.rand_unitary_haar(4, dims=[[2, 2]] * 2)
+        inputs, outputs = net.generate_training_states(5)
+        fidelities = theano.function([], net.fidelity(return_mean=False),
+            givens={net.inputs: inputs, net.outputs: outputs})()
+        # recompute fidelities with qutip, tracing out the ancilla
+        gate = net.get_current_gate()
+        fidelities_check = []
+        for input_, output in zip(inputs, outputs):
+            dm = (gate * bigreal2qobj(input_)).ptrace([0, 1])
+            output = bigreal2qobj(output)
+            fidelities_check.append((output.dag() * dm * output)[0, 0].real)
+        assert_almost_equal(fidelities, fidelities_check)
+
+    def test_initial_values_from_dict(self):
+        net = QubitNetworkModel(
+            num_qubits=2, interactions=[(1, 0), (0, 3), (2, 2)],
+            initial_values={sympy.Symbol('J10'): 1., 'J03': 2., (2, 2): 3.})
+        assert_almost_equal(net.initial_values, [1., 2., 3.])
+        net = QubitNetworkModel(
+            num_qubits=2, interactions=[(1, 0), (0, 3), (2, 2)],
+            initial_values={'J22': 3.})
+        assert_almost_equal(net.initial_values, [0., 0., 3.])
+        with self.assertRaises(ValueError):
+            QubitNetworkModel(num_qubits=2, interactions=[(1, 0)],
+                              initial_values={'J33': 1.})
+
+    def test_net_parameters_to_dataframe(self):
+        net = QubitNetworkModel(num_qubits=2, interactions=[(1, 0), (3, 3)],
+                                initial_values={'J10': 1., 'J33': 2.})
+        df = net.net_parameters_to_dataframe(stringify_index=True)
+        self.assertListEqual(df.index.tolist(), ['J10', 'J33'])
+        assert_almost_equal(df['value'].values, [1., 2.])
+
+    def test_remove_interaction(self):
+        net = QubitNetworkModel(
+            num_qubits=2, interactions=[(1, 0), (0, 3), (2, 2)],
+            initial_values={'J10': 1., 'J03': 2., 'J22': 3.})
+        net.target_gate = qutip.rand_unitary_haar(4, dims=[[2, 2], [2, 2]])
+        # compile the fidelity before removing the interaction
+        inputs, outputs = net.generate_training_states(4)
+        net.test_fidelity(inputs, outputs)
+        net.remove_interaction((0, 3))
+        self.assertListEqual(net.interactions, [(1, 0), (2, 2)])
+        self.assertListEqual([str(par) for par in net.free_parameters],
+                             ['J10', 'J22'])
+        assert_almost_equal(net.parameters.get_value(), [1., 3.])
+        expected = qutip.tensor(qutip.sigmax(), qutip.qeye(2)) + 3 * (
+            qutip.tensor(qutip.sigmay(), qutip.sigmay()))
+        assert_almost_equal(net.get_current_hamiltonian(), expected.full())
+        assert_almost_equal(
+            net.compute_evolution_matrix().eval(),
+            complex2bigreal(scipy.linalg.expm(-1j * expected.full())))
+        self.assertAlmostEqual(
+            net.test_fidelity(inputs, outputs),
+            net.test_fidelity(inputs, outputs, backend='numpy'))
+        with self.assertRaises(ValueError):
+            net.remove_interaction((0, 3))
+        # the state of an optimizer depends on the number of parameters
+        Optimizer(net, learning_rate=0.1, target_gate=qutip.cnot())
+        with self.assertRaises(RuntimeError):
+            net.remove_interaction((1, 0))
+
+    def test_bigreal_matrices(self):
+        net = QubitNetworkModel(num_qubits=2, interactions='all')
+        bigreal_matrices = net._get_bigreal_matrices()
+        self.assertEqual(bigreal_matrices.shape, (len(net.matrices), 8, 8))
+        self.assertTrue(bigreal_matrices.flags['C_CONTIGUOUS'])
+        for matrix, bigreal_matrix in zip(net.matrices, bigreal_matrices):
+            assert_almost_equal(bigreal_matrix,
+                                complex2bigreal(-1j * matrix))
+        for matrix, bigreal_matrix in zip(
+                net.matrices, net._get_bigreal_matrices(multiply_by_j=False)):
+            assert_almost_equal(bigreal_matrix, complex2bigreal(matrix))
+
+    def test_current_gate_matches_evolution_matrix(self):
+        net = QubitNetworkModel(num_qubits=3, interactions='all')
+        evolution_matrix = theano.function(
+            [], net.compute_evolution_matrix())()
+        gate = net.get_current_gate(return_qobj=False)
+        assert_almost_equal(gate, bigreal2complex(evolution_matrix))
+        assert_almost_equal(
+            gate, scipy.linalg.expm(-1j * net.get_current_hamiltonian()))
+
+    def test_gates_from_many_parameters(self):
+        net = QubitNetworkModel(num_qubits=2, interactions='all')
+        parameters = np.random.randn(3, len(net.free_parameters))
+        gates = net.get_gates(parameters)
+        self.assertEqual(gates.shape, (3, 4, 4))
+        for values, gate in zip(parameters, gates):
+            net.parameters.set_value(values)
+            assert_almost_equal(gate, scipy.linalg.expm(
+                -1j * net.get_current_hamiltonian()))
+
+    def test_fidelity_test_against_qutip(self):
+        # two system qubits plus one ancilla, random parameters
+        net = QubitNetworkModel(
+            num_qubits=3, num_system_qubits=2, interactions='all')
+        target_gate = qutip.rand_unitary_haar(4, dims=[[2, 2], [2, 2]])
+        net.target_gate = target_gate
+        inputs = net._random_input_states(5)
+        net._random_input_states = lambda num_states: inputs
+        fidelities = net.fidelity_test(n_samples=5, return_mean=False)
+        gate = net.get_current_gate()
+        for psi_in, fidelity in zip(inputs, fidelities):
+            psi_in = qutip.Qobj(psi_in.reshape((4, 1)),
+                                dims=[[2, 2], [1, 1]])
+            psi_out = gate * qutip.tensor(psi_in, net.ancillae_state)
+            dm_out = psi_out.ptrace([0, 1])
+            target = target_gate * psi_in
+            expected = (target.dag() * dm_out * target)[0, 0].real
+            self.assertAlmostEqual(fidelity, expected)
+
+    def test_test_fidelity_numpy_backend(self):
+        net = QubitNetworkModel(
+            num_qubits=3, num_system_qubits=2, interactions='all')
+        net.target_gate = qutip.rand_unitary_haar(4, dims=[[2, 2], [2, 2]])
+        inputs, outputs = net.generate_training_states(10)
+        self.assertAlmostEqual(
+            net.test_fidelity(inputs, outputs, backend='numpy'),
+            net.test_fidelity(inputs, outputs, backend='theano'))
+        with self.assertRaises(ValueError):
+            net.test_fidelity(inputs, outputs, backend='numba')
+
+    def test_fidelity_single_precision(self):
+        with theano.change_flags(floatX='float32'):
+            net = QubitNetworkModel(
+                num_qubits=3, num_system_qubits=2, interactions='all')
+            net.target_gate = qutip.rand_unitary_haar(
+                4, dims=[[2, 2], [2, 2]])
+            inputs, outputs = net.generate_training_states(10)
+            fidelities = net.fidelity(return_mean=False)
+            compute_fidelities = theano.function(
+                [net.inputs, net.outputs], fidelities)
+        self.assertEqual(inputs.dtype, np.float32)
+        self.assertEqual(fidelities.dtype, 'float32')
+        # compare with the fidelities computed in double precision
+        gate = net.get_current_gate(return_qobj=False)
+        states = (inputs[:, :8] + 1j * inputs[:, 8:]).dot(gate.T)
+        targets = outputs[:, :4] + 1j * outputs[:, 4:]
+        overlaps = np.einsum('ni,nia->na', targets.conj(),
+                             states.reshape((10, 4, 2)))
+        assert_almost_equal(compute_fidelities(inputs, outputs),
+                            np.sum(np.abs(overlaps) ** 2, axis=1), decimal=5)
+
     def test_grad_evolution(self):
         J00, J11 = sympy.symbols('J00 J11')
         hamiltonian = J00 * pauli_product(0, 0) + J11 * pauli_product(1, 1)
@@ -212,6 +375,151 @@ class TestOptimizer(unittest.TestCase):
         })()
         assert_almost_equal(fidelity, np.array(1))
 
+    def test_train_epoch_matches_minibatch_steps(self):
+        net = QubitNetworkModel(num_qubits=2, interactions='all')
+        optimizer = Optimizer(net, learning_rate=0.1, decay_rate=0.01,
+                              training_dataset_size=6, batch_size=2,
+                              n_epochs=1, target_gate=qutip.cnot())
+        optimizer._compile_model()
+        optimizer.refill_training_data()
+        inputs = optimizer.vars['train_inputs'].get_value()
+        outputs = optimizer.vars['train_outputs'].get_value()
+        initial_state = [var.get_value() for var, _ in optimizer.updates]
+        # apply the updates one minibatch at a time
+        train_minibatch = theano.function(
+            [net.inputs, net.outputs], optimizer.cost,
+            updates=optimizer.updates)
+        costs = [train_minibatch(inputs[start:start + 2],
+                                 outputs[start:start + 2])
+                 for start in range(0, 6, 2)]
+        parameters = net.parameters.get_value()
+        for (var, _), value in zip(optimizer.updates, initial_state):
+            var.set_value(value)
+        # the whole epoch in a single call
+        assert_almost_equal(optimizer.train_model(), costs)
+        assert_almost_equal(net.parameters.get_value(), parameters)
+
+    def test_recompile_when_batch_size_changes(self):
+        net = QubitNetworkModel(num_qubits=2, interactions='all')
+        optimizer = Optimizer(net, learning_rate=0.1, decay_rate=0.01,
+                              training_dataset_size=6, batch_size=2,
+                              n_epochs=1, target_gate=qutip.cnot())
+        optimizer.run(save_parameters=False, plot_every=None)
+        self.assertEqual(len(optimizer.train_model()), 3)
+        train_model = optimizer.train_model
+        optimizer.run(save_parameters=False, plot_every=None)
+        self.assertIs(optimizer.train_model, train_model)
+        optimizer.hyperpars['batch_size'] = 3
+        optimizer.run(save_parameters=False, plot_every=None)
+        self.assertEqual(len(optimizer.train_model()), 2)
+        optimizer.hyperpars['batch_size'] = 8
+        with self.assertRaises(ValueError):
+            optimizer.run(save_parameters=False, plot_every=None)
+
+    def test_adam_first_step(self):
+        net = QubitNetworkModel(num_qubits=2, interactions='all')
+        optimizer = Optimizer(net, learning_rate=0.01, sgd_method='adam',
+                              target_gate=qutip.cnot())
+        inputs, outputs = net.generate_training_states(4)
+        compute_grad = theano.function(
+            [net.inputs, net.outputs], optimizer.grad)
+        train = theano.function([net.inputs, net.outputs], optimizer.cost,
+                                updates=optimizer.updates)
+        grad = compute_grad(inputs, outputs)
+        parameters = net.parameters.get_value()
+        train(inputs, outputs)
+        # the first Adam step has size `learning_rate` along each
+        # direction, going up the gradient
+        assert_almost_equal(net.parameters.get_value() - parameters,
+                            0.01 * np.sign(grad), decimal=5)
+
+    def test_plain_sgd_step(self):
+        net = QubitNetworkModel(num_qubits=2, interactions='all')
+        optimizer = Optimizer(net, learning_rate=0.01, sgd_method='sgd',
+                              target_gate=qutip.cnot())
+        inputs, outputs = net.generate_training_states(4)
+        grad = theano.function(
+            [net.inputs, net.outputs], optimizer.grad)(inputs, outputs)
+        parameters = net.parameters.get_value()
+        theano.function([net.inputs, net.outputs], optimizer.cost,
+                        updates=optimizer.updates)(inputs, outputs)
+        assert_almost_equal(net.parameters.get_value(),
+                            parameters + 0.01 * grad)
+
+    def test_seeded_rng(self):
+        nets = [QubitNetworkModel(num_qubits=2, interactions='all',
+                                  target_gate=qutip.cnot(), rng=3)
+                for _ in range(2)]
+        assert_array_equal(nets[0].initial_values, nets[1].initial_values)
+        assert_array_equal(nets[0].generate_training_states(3)[0],
+                           nets[1].generate_training_states(3)[0])
+        optimizers = [Optimizer(net, learning_rate=0.1,
+                                training_dataset_size=3,
+                                target_gate=qutip.cnot(), rng=5)
+                      for net in nets]
+        for optimizer in optimizers:
+            optimizer.refill_training_data()
+        assert_array_equal(
+            optimizers[0].vars['train_inputs'].get_value(),
+            optimizers[1].vars['train_inputs'].get_value())
+
+    def test_save_and_load_results(self):
+        J00, J11 = sympy.symbols('J00 J11')
+        net = QubitNetworkModel(
+            sympy_expr=pauli_product(0, 0) * J00 + pauli_product(1, 1) * J11)
+        optimizer = Optimizer(net, learning_rate=0.1, decay_rate=0.01,
+                              training_dataset_size=4, batch_size=2,
+                              n_epochs=3, target_gate=qutip.cnot())
+        optimizer.log = {'fidelities': np.array([0.2, 0.5, 0.7]),
+                         'parameters': np.random.randn(3, 2)}
+        for ext in ('.pickle', '.npz'):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                file = os.path.join(tmpdir, 'results' + ext)
+                optimizer.save_results(file)
+                loaded = Optimizer.load(file)
+            self.assertEqual(loaded.hyperpars, optimizer.hyperpars)
+            self.assertEqual(loaded.net.target_gate, qutip.cnot())
+            for key in ('fidelities', 'parameters'):
+                assert_almost_equal(loaded.log[key],
+                                    optimizer._get_meaningful_history()[key])
+
+    def test_run_headless_and_save(self):
+        net = QubitNetworkModel(num_qubits=2, interactions='all')
+        optimizer = Optimizer(net, learning_rate=0.1, decay_rate=0.01,
+                              training_dataset_size=4, batch_size=2,
+                              n_epochs=3, target_gate=qutip.cnot())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'results.npz')
+            optimizer.run(len_shown_history=None, plot_every=None,
+                          save_after=file)
+            self.assertTrue(os.path.isfile(file))
+        self.assertIsNone(optimizer._fig)
+        self.assertEqual(optimizer.log['parameters'].shape,
+                         (3, len(net.free_parameters)))
+        # only store the parameters every other epoch
+        optimizer.hyperpars['n_epochs'] = 5
+        optimizer.run(plot_every=None, parameters_every=2)
+        self.assertEqual(optimizer.log['parameters'].shape,
+                         (3, len(net.free_parameters)))
+        assert_almost_equal(optimizer.log['parameters'][-1],
+                            net.parameters.get_value())
+
+    def test_run_redraws_when_stopping_early(self):
+        net = QubitNetworkModel(num_qubits=2, interactions='all')
+        optimizer = Optimizer(net, learning_rate=0.1, decay_rate=0.01,
+                              training_dataset_size=4, batch_size=2,
+                              n_epochs=5, target_gate=qutip.cnot())
+        # pretend that fidelity 1 is reached at the second epoch
+        def test_epoch(save_parameters=True):
+            n_epoch = optimizer.log['n_epoch']
+            optimizer.log['fidelities'][n_epoch] = float(n_epoch == 1)
+        drawn_epochs = []
+        optimizer.test_epoch = test_epoch
+        optimizer._update_fig = lambda len_shown_history: (
+            drawn_epochs.append(optimizer.log['n_epoch']))
+        optimizer.run(save_parameters=False, plot_every=10)
+        self.assertListEqual(drawn_epochs, [0, 1])
+
 
 if __name__ == '__main__':
     # change path to properly import qubit_network package when called
@@ -222,8 +530,7 @@ if __name__ == '__main__':
     sys.path.insert(1, PARENTDIR)
     from qubit_network.QubitNetwork import QubitNetwork
     from qubit_network.hamiltonian import pauli_product
-    from qubit_network.model import (QubitNetworkModel, Optimizer,
-                                     _fidelity_no_ptrace)
+    from qubit_network.model import QubitNetworkModel, Optimizer
     from qubit_network.utils import (bigreal2complex, complex2bigreal,
                                      bigreal2qobj, theano_matrix_grad)
 
@@ -5,8 +5,11 @@ import os
 import inspect
 
 import numpy as np
-from numpy.testing import assert_array_equal
+from numpy.testing import assert_array_equal, assert_almost_equal
+import scipy.linalg
 import qutip
+import theano
+import theano.tensor as T
 
 
 class TestComplex2BigReal(unittest.TestCase):
@@ -54,6 +57,40 @@ class TestComplex2BigReal(unittest.TestCase):
         )
 
 
+class TestTheanoExpm(unittest.TestCase):
+    def test_bigreal_unitary_expm_against_scipy(self):
+        matrix = T.dmatrix('matrix')
+        expm = theano.function(
+            [matrix], utils.theano_bigreal_unitary_expm(matrix))
+        for scale in (0., 0.1, 1., 20.):
+            values = scale * (np.random.randn(4, 4) + 1j * np.random.randn(4, 4))
+            hamiltonian = values + values.conj().T
+            assert_almost_equal(
+                expm(utils.complex2bigreal(-1j * hamiltonian)),
+                utils.complex2bigreal(scipy.linalg.expm(-1j * hamiltonian)))
+        # the exponentiated matrix must be anti-Hermitian
+        with self.assertRaises(ValueError):
+            expm(utils.complex2bigreal(np.random.randn(4, 4) + 1j))
+
+    def test_bigreal_unitary_expm_grad(self):
+        # the gradient is checked along big real anti-Hermitian matrices,
+        # parametrized by the coefficients of random Hamiltonians
+        rng = np.random.RandomState(42)
+        matrices = []
+        for _ in range(3):
+            values = rng.randn(4, 4) + 1j * rng.randn(4, 4)
+            matrices.append(
+                utils.complex2bigreal(-1j * (values + values.conj().T)))
+        matrices = np.array(matrices)
+        weights = rng.randn(8, 8)
+        def cost(parameters):
+            expm = utils.theano_bigreal_unitary_expm(
+                T.tensordot(parameters, matrices, axes=1))
+            return T.sum(expm * weights)
+        theano.gradient.verify_grad(cost, [rng.randn(3)], rng=rng)
+        # the eigenvalues are degenerate for a multiple of the identity
+        theano.gradient.verify_grad(cost, [np.zeros(3)], rng=rng)
+
 
 if __name__ == '__main__':
     # change path to properly import qubit_network package when called
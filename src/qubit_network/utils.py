@@ -29,15 +29,24 @@ def isvector(arr):
 
 def _complex2bigreal_vector(vector):
     """Convert a complex vector to big real notation."""
-    vector = vector.reshape((vector.shape[0], 1))
-    return np.concatenate((np.real(vector), np.imag(vector)), axis=0)
+    vector = vector.reshape((vector.size, 1))
+    outvector = np.empty((2 * vector.size, 1), dtype=vector.real.dtype)
+    outvector[:vector.size] = vector.real
+    outvector[vector.size:] = vector.imag
+    return outvector
 
 
 def _complex2bigreal_matrix(matrix):
     """Convert complex matrix to big real notation."""
-    first_row = np.concatenate((np.real(matrix), -np.imag(matrix)), axis=1)
-    second_row = np.concatenate((np.imag(matrix), np.real(matrix)), axis=1)
-    return np.concatenate((first_row, second_row), axis=0)
+    rows, cols = matrix.shape
+    outmatrix = np.empty((2 * rows, 2 * cols), dtype=matrix.real.dtype)
+    # the blocks are written directly in the output array, with no
+    # intermediate copies of the real and imaginary parts
+    outmatrix[:rows, :cols] = matrix.real
+    np.negative(matrix.imag, out=outmatrix[:rows, cols:])
+    outmatrix[rows:, :cols] = matrix.imag
+    outmatrix[rows:, cols:] = matrix.real
+    return outmatrix
 
 
 def complex2bigreal(arr):
@@ -55,7 +64,8 @@ def complex2bigreal(arr):
     # if qutip object, extract numpy arrays from it
     if isinstance(arr, qutip.Qobj):
         arr = arr.data.toarray()
-    arr = np.asarray(arr).astype(np.complex)
+    # no copy is made if `arr` is already an array of complex numbers
+    arr = np.asarray(arr).astype(np.complex128, copy=False)
     # if `arr` is a vector (possibly of shape Nx1 or 1xN)
     if isvector(arr):
         outarr = _complex2bigreal_vector(arr)
@@ -71,20 +81,19 @@ def bigreal2complex(arr):
     """
     arr = np.asarray(arr)
     if isvector(arr):
-        # `arr` may be a Nx1 or 1xN dimensional vector, or a flat vector
-        try:
-            arr_len = arr.shape[0] * arr.shape[1]
-        except IndexError:
-            arr_len = len(arr)
-        # make `arr` an Nx1 vector
-        arr = arr.reshape((arr_len, 1))
+        # `arr` may be a Nx1 or 1xN dimensional vector, or a flat vector.
+        # Make it an Nx1 vector
+        arr = arr.reshape((arr.size, 1))
         real_part = arr[:arr.shape[0] // 2]
         imag_part = arr[arr.shape[0] // 2:]
-        return real_part + 1j * imag_part
     else:
         real_part = arr[:arr.shape[0] // 2, :arr.shape[1] // 2]
         imag_part = arr[arr.shape[0] // 2:, :arr.shape[1] // 2]
-        return real_part + 1j * imag_part
+    # fill the complex output in place, rather than through `1j * imag_part`
+    outarr = np.empty(real_part.shape, dtype=np.complex128)
+    outarr.real = real_part
+    outarr.imag = imag_part
+    return outarr
 
 
 def bigreal2qobj(arr):
@@ -124,6 +133,110 @@ def theano_matrix_grad(matrix, parameters):
         else:
             return T.reshape(flattened_grads, shape)
 
+
+def _bigreal_hermitian_eigh(matrix):
+    """Diagonalize the Hermitian matrix `H` given `-1j * H` in big real form.
+
+    Only the first block column of `matrix`, which contains both the
+    real and the imaginary part of `-1j * H`, is used. Returns the
+    eigenvalues and eigenvectors of `H`, as `numpy.linalg.eigh` does.
+    A ValueError is raised if `H` is not Hermitian, as `numpy.linalg.eigh`
+    would otherwise silently use only its lower triangle.
+    """
+    dim = matrix.shape[0] // 2
+    hamiltonian = 1j * (matrix[:dim, :dim] + 1j * matrix[dim:, :dim])
+    if not np.allclose(hamiltonian, hamiltonian.conj().T):
+        raise ValueError('The exponentiated matrix must be -1j times a '
+                         'Hermitian matrix.')
+    return np.linalg.eigh(hamiltonian)
+
+
+class BigRealUnitaryExpm(theano.Op):
+    """Exponential of `-1j * H`, with `H` Hermitian, in big real form.
+
+    The input is the big real form of the anti-Hermitian matrix `-1j * H`,
+    and the output the big real form of the unitary `exp(-1j * H)`. This
+    is computed from the eigendecomposition of `H`, which is cheaper than
+    a Pade approximant and, more importantly, allows to compute the
+    gradient in a single step (see `BigRealUnitaryExpmGrad`) rather than
+    backpropagating through the squarings.
+    The input must be anti-Hermitian, that is `H` must be Hermitian, or
+    a ValueError is raised when the node is evaluated.
+    """
+    __props__ = ()
+
+    def make_node(self, matrix):
+        matrix = T.as_tensor_variable(matrix)
+        assert matrix.ndim == 2
+        return theano.Apply(self, [matrix], [matrix.type()])
+
+    def perform(self, node, inputs, outputs):
+        (matrix,) = inputs
+        eigenvalues, eigenvectors = _bigreal_hermitian_eigh(matrix)
+        unitary = (eigenvectors * np.exp(-1j * eigenvalues)).dot(
+            eigenvectors.conj().T)
+        outputs[0][0] = _complex2bigreal_matrix(unitary).astype(
+            node.outputs[0].dtype)
+
+    def infer_shape(self, node, shapes):
+        return [shapes[0]]
+
+    def grad(self, inputs, output_grads):
+        return [BigRealUnitaryExpmGrad()(inputs[0], output_grads[0])]
+
+
+class BigRealUnitaryExpmGrad(theano.Op):
+    """Gradient of `BigRealUnitaryExpm`.
+
+    Writing `M = -1j * H`, the gradient of the cost with respect to `M`
+    is the Frechet derivative of the exponential at `M^dagger` in the
+    direction of the (complex) gradient `g` with respect to `exp(M)`.
+    In the eigenbasis of `H` this is the elementwise product of `g` with
+    the divided differences of the exponential (Daleckii-Krein formula),
+    here written in terms of `sinc` so that degenerate eigenvalues need
+    no special treatment.
+    Only the components of the gradient along big real matrices are
+    retained, as the input is assumed to be a big real matrix.
+    """
+    __props__ = ()
+
+    def make_node(self, matrix, output_grad):
+        matrix = T.as_tensor_variable(matrix)
+        output_grad = T.as_tensor_variable(output_grad)
+        return theano.Apply(self, [matrix, output_grad], [matrix.type()])
+
+    def perform(self, node, inputs, outputs):
+        matrix, output_grad = inputs
+        dim = matrix.shape[0] // 2
+        eigenvalues, eigenvectors = _bigreal_hermitian_eigh(matrix)
+        # projection of the gradient onto the big real matrices
+        grad = (output_grad[:dim, :dim] + output_grad[dim:, dim:] +
+                1j * (output_grad[dim:, :dim] - output_grad[:dim, dim:])) / 2
+        # divided differences of `exp(1j * x)` on the eigenvalues of `H`
+        means = (eigenvalues[:, None] + eigenvalues[None, :]) / 2
+        differences = eigenvalues[:, None] - eigenvalues[None, :]
+        divided_differences = np.exp(1j * means) * np.sinc(
+            differences / (2 * np.pi))
+        eigenvectors_dag = eigenvectors.conj().T
+        grad = eigenvectors.dot(
+            eigenvectors_dag.dot(grad).dot(eigenvectors) *
+            divided_differences).dot(eigenvectors_dag)
+        outputs[0][0] = _complex2bigreal_matrix(grad).astype(
+            node.outputs[0].dtype)
+
+    def infer_shape(self, node, shapes):
+        return [shapes[0]]
+
+
+def theano_bigreal_unitary_expm(matrix):
+    """Build the graph of `exp(-1j * H)` given `-1j * H` in big real form.
+
+    See `BigRealUnitaryExpm`. The input must be the big real form of an
+    anti-Hermitian matrix.
+    """
+    return BigRealUnitaryExpm()(matrix)
+
+
 def get_sigmas_index(indices):
     """Takes a tuple and gives back a length-16 array with a single 1.
 
@@ -181,19 +294,16 @@ def pauli_product(*pauli_indices):
     return partial_product
 
 
+_PAULI_CHARS = {'x': 1, 'y': 2, 'z': 3}
+
+
 def chars2pair(chars):
-    out_pair = []
-    for idx in range(len(chars)):
-        if chars[idx] == 'x':
-            out_pair.append(1)
-        elif chars[idx] == 'y':
-            out_pair.append(2)
-        elif chars[idx] == 'z':
-            out_pair.append(3)
-        else:
-            raise ValueError('chars must contain 2 characters, each of'
-                             'which equal to either x, y, or z')
-    return tuple(out_pair)
+    """Convert a string like 'xz' into the Pauli indices (1, 3)."""
+    try:
+        return tuple(_PAULI_CHARS[char] for char in chars)
+    except KeyError:
+        raise ValueError('chars must contain only characters equal to'
+                         ' either x, y, or z')
 
 
 def dm2ket(dm):
@@ -213,14 +323,15 @@ def ket_normalize(ket):
 
 def detensorize(bigm):
     """Assumes second matrix is 2x2."""
-    out = np.zeros((bigm.shape[0] * bigm.shape[1], 2, 2), dtype=np.complex)
+    out = np.zeros((bigm.shape[0] * bigm.shape[1], 2, 2),
+                   dtype=np.complex128)
     idx = 0
     for row in range(bigm.shape[0] // 2):
         for col in range(bigm.shape[1] // 2):
             trow = 2 * row
             tcol = 2 * col
-            foo = np.zeros([2, 2], dtype=np.complex)
-            foo = np.zeros([2, 2], dtype=np.complex)
+            foo = np.zeros([2, 2], dtype=np.complex128)
+            foo = np.zeros([2, 2], dtype=np.complex128)
             foo[0, 0] = 1
             foo[0, 1] = bigm[trow, tcol + 1] / bigm[trow, tcol]
             foo[1, 0] = bigm[trow + 1, tcol] / bigm[trow, tcol]
@@ -238,7 +349,7 @@ def chop(arr, eps=1e-5):
         _arr = qutip.Qobj(_arr, dims=arr.dims)
         return _arr
     else:
-        _arr = np.array(arr).astype(np.complex)
+        _arr = np.array(arr).astype(np.complex128)
         _arr.real[np.abs(_arr.real) < eps] = 0.0
         _arr.imag[np.abs(_arr.imag) < eps] = 0.0
         return _arr